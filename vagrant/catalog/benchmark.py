@@ -0,0 +1,357 @@
+"""
+Benchmark suite for the Catalog App routes.
+
+Synthetic catalogs of the requested sizes are generated once and kept in
+the fixture directory. Every size is benchmarked in a fresh process on a
+copy of its fixture, first through the Flask test client and then
+through a threaded WSGI server driven by concurrent HTTP clients.
+
+Usage:
+    python benchmark.py --sizes 1000 100000 1000000 -o results.json
+
+The results are written as JSON: p50/p99/mean latency and throughput per
+size, driver and route, plus the peak RSS of every benchmark process.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(HERE, 'benchmark_fixtures')
+CATEGORIES = 20
+USER_ID = 1
+STATE = 'benchmark'
+
+
+def percentile(samples, fraction):
+    """ Nearest rank percentile of a sorted list """
+    if not samples:
+        return None
+    index = max(0, int(round(fraction * len(samples))) - 1)
+    return samples[min(index, len(samples) - 1)]
+
+
+def summarize(route, driver, latencies, elapsed, errors):
+    latencies = sorted(latencies)
+    return {
+        'route': route,
+        'driver': driver,
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+    }
+
+
+def peakRss():
+    """ Peak resident set size of this process in KB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def itemTitle(index):
+    return 'item {}'.format(index)
+
+
+def categoryName(index):
+    return 'category {}'.format(index % CATEGORIES)
+
+
+def generateFixture(size):
+    """ Fills the configured database with size items """
+    from catalogtool import Importer
+    from databasemodels import User, initDatabase
+
+    engine = initDatabase()
+
+    engine.execute(User.__table__.insert(),
+                   {'id': USER_ID, 'username': 'benchmark'})
+    records = ({'category': categoryName(index),
+                'title': itemTitle(index),
+                'description': 'Description of item {}'.format(index),
+                'user_id': USER_ID}
+               for index in range(size))
+    Importer(engine).run(records)
+
+
+def prepareFixture(size):
+    """ Returns the path of the fixture database of the given size,
+    generating it first if needed.
+    """
+    directory = os.path.join(FIXTURE_DIR, 'items-{}'.format(size))
+    database = os.path.join(directory, 'itemcatalog.db')
+    if not os.path.exists(database):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        subprocess.check_call(
+            [sys.executable, os.path.abspath(__file__), 'generate',
+             str(size)],
+            cwd=HERE, env=workerEnvironment(database))
+    return database
+
+
+def workerEnvironment(database):
+    env = dict(os.environ)
+    env['CATALOG_DATABASE_URL'] = 'sqlite:///' + database
+    # The WSGI clients send a session cookie signed by the benchmark
+    env['CATALOG_SESSION_BACKEND'] = 'cookie'
+    return env
+
+
+class Workload(object):
+    """ Requests issued against the app for one fixture size """
+
+    def __init__(self, size, app):
+        self.size = size
+        self.app = app
+        self.created = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(size)
+
+    def _index(self):
+        with self._lock:
+            return self._random.randrange(self.size)
+
+    def home(self):
+        return 'GET', '/', None
+
+    def getAllCategoryItems(self):
+        return 'GET', '/catalog/{}/items'.format(
+            quote(categoryName(self._index()))), None
+
+    def getItemDesc(self):
+        index = self._index()
+        return 'GET', '/catalog/{}/{}'.format(
+            quote(categoryName(index)), quote(itemTitle(index))), None
+
+    def getCatalog(self):
+        return 'GET', '/catalog.json', None
+
+    def newCategoryItem(self):
+        with self._lock:
+            self.created += 1
+            title = 'benchmark {}'.format(self.created)
+        return 'POST', '/item/new/', {
+            'state': STATE, 'name': title, 'desc': 'Benchmark item',
+            'category': str(self._index() % CATEGORIES + 1)}
+
+    def editItem(self):
+        # Fixture items are numbered in insertion order, so item i has the
+        # id i + 1. Only the description changes to keep titles unique.
+        index = self._index()
+        return 'POST', '/catalog/{}/edit'.format(quote(itemTitle(index))), {
+            'state': STATE, 'name': itemTitle(index),
+            'desc': 'Edited at {}'.format(time.time()),
+            'currentId': str(index + 1)}
+
+    def deleteItem(self):
+        with self._lock:
+            item_id = self._deletable.pop()
+        return 'POST', '/catalog/benchmark/delete', json.dumps(
+            {'state': STATE, 'id': item_id})
+
+    def prepareDeletes(self):
+        from databasemodels import Item
+        from views import ensureResources, g_session
+        ensureResources()
+        self._deletable = [item_id for (item_id,) in g_session.query(
+            Item.id).filter(Item.title.like('benchmark %'))]
+        g_session.remove()
+        return len(self._deletable)
+
+
+def loginSession():
+    return {'username': 'benchmark', 'user_id': USER_ID, 'state': STATE}
+
+
+def runTestClient(workload, route, count):
+    """ Issues count requests to a route through the Flask test client """
+    client = workload.app.test_client()
+    with client.session_transaction() as session:
+        session.update(loginSession())
+    latencies = []
+    errors = 0
+    started = time.monotonic()
+    for _ in range(count):
+        method, url, data = getattr(workload, route)()
+        if method == 'POST':
+            with client.session_transaction() as session:
+                session['state'] = STATE
+        begin = time.monotonic()
+        response = client.open(url, method=method, data=data)
+        response.get_data()
+        latencies.append(time.monotonic() - begin)
+        if response.status_code >= 400:
+            errors += 1
+    return summarize(route, 'test_client', latencies,
+                     time.monotonic() - started, errors)
+
+
+def runWsgi(workload, route, count, concurrency, baseUrl, cookie):
+    """ Issues count requests to a route over HTTP from concurrency
+    client threads.
+    """
+    import requests
+
+    local = threading.local()
+
+    def one(_):
+        http = getattr(local, 'http', None)
+        if http is None:
+            http = local.http = requests.Session()
+        method, url, data = getattr(workload, route)()
+        http.cookies.clear()
+        begin = time.monotonic()
+        response = http.request(method, baseUrl + url, data=data,
+                                headers={'Cookie': cookie})
+        response.content
+        return time.monotonic() - begin, response.status_code >= 400
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(count)))
+    return summarize(route, 'wsgi', [latency for latency, _ in results],
+                     time.monotonic() - started,
+                     sum(1 for _, failed in results if failed))
+
+
+READ_ROUTES = ['home', 'getAllCategoryItems', 'getItemDesc']
+WRITE_ROUTES = ['newCategoryItem', 'editItem', 'deleteItem']
+
+
+def runWorker(size, requests, exportRequests, concurrency):
+    """ Benchmarks the app on the configured database and prints the
+    results as JSON.
+    """
+    from werkzeug.serving import make_server
+    import views
+
+    app = views.create_app()
+    workload = Workload(size, app)
+    counts = dict((route, requests) for route in READ_ROUTES + WRITE_ROUTES)
+    counts['getCatalog'] = exportRequests
+
+    results = []
+    for route in READ_ROUTES + ['getCatalog'] + WRITE_ROUTES:
+        if route == 'deleteItem':
+            counts[route] = workload.prepareDeletes() // 2
+        results.append(runTestClient(workload, route, counts[route]))
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    baseUrl = 'http://127.0.0.1:{}'.format(server.server_port)
+    cookie = '{}={}'.format(
+        app.session_cookie_name,
+        app.session_interface.get_signing_serializer(app).dumps(
+            loginSession()))
+    try:
+        for route in READ_ROUTES + ['getCatalog'] + WRITE_ROUTES:
+            if route == 'deleteItem':
+                counts[route] = workload.prepareDeletes()
+            results.append(runWsgi(workload, route, counts[route],
+                                   concurrency, baseUrl, cookie))
+    finally:
+        server.shutdown()
+
+    for result in results:
+        result['size'] = size
+    json.dump({'size': size, 'peak_rss_kb': peakRss(), 'results': results},
+              sys.stdout)
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=HERE,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 100000, 1000000],
+                        help='numbers of items in the generated catalogs')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route and driver')
+    parser.add_argument('--export-requests', type=int, default=3,
+                        help='requests to /catalog.json per driver')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='client threads used against the WSGI server')
+    parser.add_argument('-o', '--output', default='-',
+                        help="file to write the results to, '-' for stdout")
+    parser.add_argument('mode', nargs='?', default='run',
+                        choices=['run', 'generate', 'worker'],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('size', nargs='?', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.mode == 'generate':
+        generateFixture(args.size)
+        return
+    if args.mode == 'worker':
+        runWorker(args.size, args.requests, args.export_requests,
+                  args.concurrency)
+        return
+
+    report = {
+        'commit': gitCommit(),
+        'python': platform.python_version(),
+        'started': datetime.datetime.utcnow().isoformat() + 'Z',
+        'parameters': {'requests': args.requests,
+                       'export_requests': args.export_requests,
+                       'concurrency': args.concurrency},
+        'results': [],
+        'peak_rss_kb': {},
+    }
+    for size in args.sizes:
+        fixture = prepareFixture(size)
+        workdir = tempfile.mkdtemp(prefix='catalog-benchmark-')
+        try:
+            database = os.path.join(workdir, 'itemcatalog.db')
+            shutil.copy(fixture, database)
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), 'worker',
+                 str(size), '--requests', str(args.requests),
+                 '--export-requests', str(args.export_requests),
+                 '--concurrency', str(args.concurrency)],
+                cwd=HERE, env=workerEnvironment(database))
+        finally:
+            shutil.rmtree(workdir)
+        run = json.loads(output.decode())
+        report['results'].extend(run['results'])
+        report['peak_rss_kb'][str(size)] = run['peak_rss_kb']
+        for result in run['results']:
+            print('{size:>8} {driver:<12} {route:<20} p50 {p50_ms:>9.3f} ms '
+                  'p99 {p99_ms:>9.3f} ms {throughput_rps:>8.1f} req/s '
+                  '{errors} errors'.format(**result), file=sys.stderr)
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+Fingerprinted and precompressed static assets for the Catalog App.
+
+The build step copies every file of the static directory to static/dist
+under a name carrying a hash of its content, next to gzip (and, when the
+brotli package is installed, brotli) compressed copies, and writes a
+manifest mapping the original names to the hashed ones:
+
+    python catalogassets.py
+
+Templates link assets with asset_url('css/bootstrap.min.css'). Once the
+manifest exists that points at /assets/<hashed name>, served with the
+best precompressed variant the client accepts and cached for a year, as
+the content behind a hashed name never changes. Without a build, the
+plain /static/ URLs are used.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from flask import abort, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(HERE, 'static')
+DIST_NAME = 'dist'
+MANIFEST_NAME = 'manifest.json'
+
+# Characters of the content hash put into the file names
+HASH_LENGTH = 12
+
+# Only these files are worth compressing, images already are
+COMPRESSED_TYPES = ('.css', '.js', '.map', '.json', '.svg', '.txt', '.html')
+
+# Compressed copies saving less than this fraction of the size are dropped
+MIN_SAVING = 0.1
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Content-Encoding of every variant, best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def fingerprint(path, content):
+    """ Returns path with a hash of content inserted before its extension,
+    e.g. css/site.css becomes css/site.0123456789ab.css
+    """
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    root, extension = os.path.splitext(path)
+    return '{}.{}{}'.format(root, digest, extension)
+
+
+def compressedVariants(content):
+    """ Returns (suffix, compressed content) of the variants worth keeping """
+    variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content)))
+    return [(suffix, data) for suffix, data in variants
+            if len(data) <= len(content) * (1 - MIN_SAVING)]
+
+
+def buildAssets(staticDir=STATIC_DIR):
+    """ Builds the dist directory of staticDir from scratch.
+
+    Args:
+        staticDir: directory holding the static files
+
+    Returns:
+        The manifest, mapping the paths of the static files relative to
+        staticDir to their fingerprinted paths in the dist directory
+    """
+    distDir = os.path.join(staticDir, DIST_NAME)
+    if os.path.isdir(distDir):
+        shutil.rmtree(distDir)
+
+    manifest = {}
+    for directory, subdirectories, files in os.walk(staticDir):
+        if directory == staticDir and DIST_NAME in subdirectories:
+            subdirectories.remove(DIST_NAME)
+        subdirectories.sort()
+        for name in sorted(files):
+            source = os.path.join(directory, name)
+            path = os.path.relpath(source, staticDir).replace(os.sep, '/')
+            with open(source, 'rb') as sourceFile:
+                content = sourceFile.read()
+            hashed = fingerprint(path, content)
+            target = os.path.join(distDir, *hashed.split('/'))
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            with open(target, 'wb') as targetFile:
+                targetFile.write(content)
+            if os.path.splitext(name)[1].lower() in COMPRESSED_TYPES:
+                for suffix, data in compressedVariants(content):
+                    with open(target + suffix, 'wb') as targetFile:
+                        targetFile.write(data)
+            manifest[path] = hashed
+
+    with open(os.path.join(distDir, MANIFEST_NAME), 'w') as manifestFile:
+        json.dump(manifest, manifestFile, indent=2, sort_keys=True)
+    return manifest
+
+
+class Assets(object):
+    """ Serves the built assets on /assets/ and provides asset_url() to
+    the templates.
+    """
+
+    def __init__(self, app, staticDir=STATIC_DIR):
+        self._distDir = os.path.join(staticDir, DIST_NAME)
+        self._manifest = {}
+        manifestPath = os.path.join(self._distDir, MANIFEST_NAME)
+        if os.path.exists(manifestPath):
+            with open(manifestPath) as manifestFile:
+                self._manifest = json.load(manifestFile)
+        self._hashed = frozenset(self._manifest.values())
+
+        app.add_url_rule('/assets/<path:filename>', 'asset', self.asset)
+        app.context_processor(self._templateContext)
+
+    def _templateContext(self):
+        return {'asset_url': self.url}
+
+    def url(self, path):
+        """ Returns the URL of a static file, its fingerprinted copy when
+        the assets have been built.
+
+        Args:
+            path: path of the file relative to the static directory
+        """
+        hashed = self._manifest.get(path)
+        if hashed is None:
+            return url_for('static', filename=path)
+        return url_for('asset', filename=hashed)
+
+    def asset(self, filename):
+        """ Serves a fingerprinted asset
+
+        Args:
+            filename: fingerprinted path of the asset
+
+        Returns:
+            on GET:
+                The best precompressed variant the client accepts, or the
+                asset itself, cacheable for a year, 404 for names not
+                in the manifest
+        """
+        if filename not in self._hashed:
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or \
+            'application/octet-stream'
+        accepted = request.accept_encodings
+        encoding = None
+        served = filename
+        for name, suffix in ENCODINGS:
+            if accepted[name] and os.path.isfile(
+                    os.path.join(self._distDir, filename + suffix)):
+                encoding = name
+                served = filename + suffix
+                break
+
+        response = send_from_directory(self._distDir, served,
+                                       mimetype=mimetype)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = CACHE_CONTROL
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--static', default=STATIC_DIR,
+                        help='directory holding the static files')
+    args = parser.parse_args(argv)
+    manifest = buildAssets(args.static)
+    print('Built {} assets{}'.format(
+        len(manifest), '' if brotli is not None else
+        ' (brotli is not installed, gzip only)'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Process wide caches of catalog data, kept current with the version
+counters stored in the catalog_version table
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import event, select
+
+from databasemodels import CATEGORIES_VERSION, CatalogVersion, Category
+
+
+class CatalogVersions(object):
+    """ Cached view of the catalog version counters.
+
+    The counters are read from the database at most once every ttl
+    seconds. Commits made by this process expire the cached counters
+    right away, so a worker always sees its own changes immediately and
+    changes made by other workers within ttl seconds.
+    """
+
+    def __init__(self, engine, ttl=1.0):
+        self._engine = engine
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._checked = None
+
+    def get(self, name):
+        """ Returns the current value of a version counter.
+
+        Args:
+            name: name of the counter
+
+        Returns:
+            The counter value, 0 if it was never bumped
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._checked is not None and now - self._checked < self._ttl:
+                return self._versions.get(name, 0)
+
+        table = CatalogVersion.__table__
+        rows = self._engine.execute(
+            select([table.c.name, table.c.version])).fetchall()
+        with self._lock:
+            self._versions = dict(rows)
+            self._checked = now
+            return self._versions.get(name, 0)
+
+    def expire(self):
+        """ Makes the next get() read the counters from the database. """
+        with self._lock:
+            self._checked = None
+
+    def watch(self, sessionFactory):
+        """ Expires the counters whenever a session created by
+        sessionFactory commits a change which bumped one of them.
+        """
+        @event.listens_for(sessionFactory, 'after_commit')
+        def expireOnCommit(session):
+            if session.info.pop('bumped_versions', None):
+                self.expire()
+
+
+class CategoryRecord(namedtuple('CategoryRecord', ['id', 'name'])):
+    """ Immutable copy of a Category row which can be shared by threads """
+    __slots__ = ()
+
+    @property
+    def serialize(self):
+        return {
+            "name": self.name,
+            "id": self.id
+        }
+
+
+_Snapshot = namedtuple('_Snapshot', ['version', 'categories', 'byName',
+                                     'byId'])
+
+
+class CategoryRegistry(object):
+    """ All categories, indexed by name and id.
+
+    The categories are reloaded whenever the categories version counter
+    changes. Lookups work on an immutable snapshot, so readers never need
+    to take a lock.
+    """
+
+    def __init__(self, engine, versions):
+        self._engine = engine
+        self._versions = versions
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def _current(self):
+        version = self._versions.get(CATEGORIES_VERSION)
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.version != version:
+                table = Category.__table__
+                rows = self._engine.execute(
+                    select([table.c.id, table.c.name]).
+                    order_by(table.c.id)).fetchall()
+                categories = tuple(CategoryRecord(row.id, row.name)
+                                   for row in rows)
+                snapshot = _Snapshot(
+                    version, categories,
+                    dict((category.name, category)
+                         for category in categories),
+                    dict((category.id, category)
+                         for category in categories))
+                self._snapshot = snapshot
+        return snapshot
+
+    def all(self):
+        """ Returns all categories ordered by id """
+        return self._current().categories
+
+    def byName(self, name):
+        """ Returns the category with the given name, None if unknown """
+        return self._current().byName.get(name)
+
+    def byId(self, cat_id):
+        """ Returns the category with the given id, None if unknown """
+        return self._current().byId.get(cat_id)
+
+    def invalidate(self):
+        """ Drops the loaded categories, they are read again on next use """
+        with self._lock:
+            self._snapshot = None
+
+
+class LRUCache(object):
+    """ Thread safe mapping holding up to maxsize entries.
+
+    Once full, the least recently used entry is evicted to make room.
+    Callers put the versions their value depends on into the key, so stale
+    entries are simply never asked for again and age out.
+    """
+
+    def __init__(self, maxsize=512):
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """ Returns the value cached for key, None if there is none """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """ Caches value under key, evicting the oldest entry if needed """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """ Drops the value cached for key, if any """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,148 @@
+"""
+Incremental change feed of the catalog items.
+
+Every transaction changing items bumps the items version counter and
+stamps the items it writes, and the tombstones of the items it deletes,
+with the new value (see databasemodels.bumpChangedVersions()). The
+counter row stays locked until the transaction ends, so these stamps
+follow the order in which the changes were committed. Changes are read
+in that order: items by (change_seq, id) and tombstones by
+(change_seq, id), both straight from an index. The cursor handed to the
+client holds the position reached in each of the two, so a sync client
+only reads what changed since its previous call, and a transaction
+committing late can't slip in behind a cursor.
+"""
+
+import base64
+import binascii
+
+from sqlalchemy import and_, or_, select
+
+from catalogjson import COLUMNS, itemDict
+from databasemodels import (ITEMS_VERSION, CatalogVersion, Item,
+                            ItemTombstone)
+
+
+FEED_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Position at the start of the feed: (change_seq, id) of the last item
+# and (change_seq, id) of the last tombstone read
+START = (None, None, None, None)
+
+
+class CursorError(ValueError):
+    """ Raised for feed cursors which were not created by encodeCursor() """
+
+
+def encodeCursor(position):
+    """ Encodes a feed position as an opaque, url safe string """
+    fields = ['' if field is None else str(field) for field in position]
+    return base64.urlsafe_b64encode('|'.join(fields).encode()).decode()
+
+
+def decodeCursor(cursor):
+    """ Decodes a cursor created by encodeCursor()
+
+    Args:
+        cursor: cursor string received from the client, None or empty for
+            the start of the feed
+
+    Returns:
+        The feed position
+
+    Raises:
+        CursorError: the cursor is malformed
+    """
+    if not cursor:
+        return START
+    try:
+        itemSeq, itemId, tombstoneSeq, tombstoneId = \
+            base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        position = tuple(int(field) if field else None
+                         for field in (itemSeq, itemId,
+                                       tombstoneSeq, tombstoneId))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise CursorError(cursor)
+    if (position[0] is None) != (position[1] is None) or \
+            (position[2] is None) != (position[3] is None):
+        raise CursorError(cursor)
+    return position
+
+
+def after(seqColumn, idColumn, seq, rowId):
+    """ Filter for the rows past (seq, rowId), in a form that can be
+    answered with a range scan of a (seq, id) index.
+    """
+    return and_(seqColumn >= seq,
+                or_(seqColumn > seq, idColumn > rowId))
+
+
+def readChanges(connection, position, size):
+    """ Reads the next changes of the feed.
+
+    Only changes of transactions committed when the items version is read
+    are returned, so the items and tombstones read by the two queries
+    that follow cover the same transactions.
+
+    Args:
+        connection: connection to read from
+        position: feed position, as returned by decodeCursor()
+        size: maximum number of changes to return
+
+    Returns:
+        (changes, position, more) tuple. changes is a list of change
+        documents, oldest first; deletes come before updates made by the
+        same transaction. position is the feed position after the last of
+        them and more tells whether further changes are waiting.
+    """
+    itemSeq, itemId, tombstoneSeq, tombstoneId = position
+    versions = CatalogVersion.__table__
+    horizon = connection.execute(
+        select([versions.c.version]).
+        where(versions.c.name == ITEMS_VERSION)).scalar() or 0
+
+    items = Item.__table__
+    query = select(COLUMNS + [items.c.lastupdated, items.c.change_seq]).\
+        where(items.c.change_seq <= horizon)
+    if itemSeq is not None:
+        query = query.where(after(items.c.change_seq, items.c.id,
+                                  itemSeq, itemId))
+    query = query.order_by(items.c.change_seq, items.c.id).limit(size + 1)
+    entries = [(row.change_seq, 1, row.id, row)
+               for row in connection.execute(query)]
+
+    tombstones = ItemTombstone.__table__
+    query = select([tombstones.c.id, tombstones.c.item_id,
+                    tombstones.c.cat_id, tombstones.c.deleted,
+                    tombstones.c.change_seq]).\
+        where(tombstones.c.change_seq <= horizon)
+    if tombstoneSeq is not None:
+        query = query.where(after(tombstones.c.change_seq, tombstones.c.id,
+                                  tombstoneSeq, tombstoneId))
+    query = query.order_by(tombstones.c.change_seq, tombstones.c.id).\
+        limit(size + 1)
+    entries.extend((row.change_seq, 0, row.id, row)
+                   for row in connection.execute(query))
+
+    # Each list alone is ordered. Merged, the first size entries are the
+    # next size changes: anything not fetched comes after all of them.
+    entries.sort(key=lambda entry: entry[:3])
+    more = len(entries) > size
+    changes = []
+    for seq, isItem, rowId, row in entries[:size]:
+        if isItem:
+            itemSeq, itemId = seq, rowId
+            changes.append({
+                "op": "update",
+                "item": itemDict(row),
+                "lastupdated": row.lastupdated.strftime(FEED_TIME_FORMAT),
+            })
+        else:
+            tombstoneSeq, tombstoneId = seq, rowId
+            changes.append({
+                "op": "delete",
+                "id": row.item_id,
+                "cat_id": row.cat_id,
+                "deleted": row.deleted.strftime(FEED_TIME_FORMAT),
+            })
+    return changes, (itemSeq, itemId, tombstoneSeq, tombstoneId), more
@@ -0,0 +1,136 @@
+"""
+Tests of the change feed, run against a temporary SQLite database:
+
+    python -m unittest catalogchanges_test
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy.orm import sessionmaker
+
+import catalogchanges
+from catalogconfig import createEngine
+from catalogtool import Importer
+from databasemodels import Category, Item, User, initDatabase
+
+
+class ChangeFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = initDatabase(createEngine(
+            'sqlite:///' + os.path.join(self.directory, 'catalog.db')))
+        self.Session = sessionmaker(bind=self.engine)
+        session = self.Session()
+        session.add_all([User(id=1, username='Owner'),
+                         Category(id=1, name='Soccer')])
+        session.commit()
+        session.close()
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def addItems(self, *titles):
+        session = self.Session()
+        items = [Item(title=title, cat_id=1, user_id=1) for title in titles]
+        session.add_all(items)
+        session.commit()
+        ids = [item.id for item in items]
+        session.close()
+        return ids
+
+    def read(self, position=catalogchanges.START, size=1000):
+        with self.engine.connect() as connection:
+            return catalogchanges.readChanges(connection, position, size)
+
+    def readAll(self, position=catalogchanges.START, size=1000):
+        changes = []
+        more = True
+        while more:
+            page, position, more = self.read(position, size)
+            changes.extend(page)
+        return changes, position
+
+    def summary(self, changes):
+        return [(change['op'], change['item']['title']
+                 if change['op'] == 'update' else change['id'])
+                for change in changes]
+
+    def test_changes_in_commit_order(self):
+        first, second = self.addItems('first', 'second')
+        session = self.Session()
+        session.query(Item).get(first).desc = 'Edited'
+        session.commit()
+        session.delete(session.query(Item).get(second))
+        session.commit()
+        session.close()
+
+        changes, position = self.readAll()
+        self.assertEqual(self.summary(changes),
+                         [('update', 'first'), ('delete', second)])
+        self.assertEqual(self.read(position)[0], [])
+
+    def test_late_commit_not_skipped(self):
+        # An item edited in a transaction which flushes before, but
+        # commits after, another transaction must not be skipped by a
+        # cursor taken in between.
+        first, = self.addItems('first')
+        writer = self.Session()
+        writer.query(Item).get(first).desc = 'Edited'
+        writer.flush()
+
+        changes, position, more = self.read()
+        self.assertEqual(self.summary(changes), [('update', 'first')])
+        self.assertIsNone(changes[0]['item']['description'])
+
+        writer.commit()
+        writer.close()
+        self.addItems('second')
+        changes, position, more = self.read(position)
+        self.assertEqual(self.summary(changes),
+                         [('update', 'first'), ('update', 'second')])
+        self.assertEqual(changes[0]['item']['description'], 'Edited')
+
+    def test_pages_match_single_read(self):
+        ids = self.addItems(*['item {}'.format(index) for index in range(7)])
+        session = self.Session()
+        for item_id in ids[::2]:
+            session.query(Item).get(item_id).desc = 'Edited'
+        session.commit()
+        for item_id in ids[1:4]:
+            session.delete(session.query(Item).get(item_id))
+        session.commit()
+        session.close()
+
+        whole, position = self.readAll()
+        for size in (1, 2, 3):
+            paged, pagedPosition = self.readAll(size=size)
+            self.assertEqual(paged, whole)
+            self.assertEqual(pagedPosition, position)
+
+    def test_imported_items_listed(self):
+        self.addItems('before')
+        changes, position = self.readAll()
+        Importer(self.engine).run([{'category': 'Hockey', 'title': 'puck'}])
+        changes, position = self.readAll(position)
+        self.assertEqual(self.summary(changes), [('update', 'puck')])
+
+    def test_cursor_round_trip(self):
+        self.addItems('first')
+        changes, position, more = self.read()
+        cursor = catalogchanges.encodeCursor(position)
+        self.assertEqual(catalogchanges.decodeCursor(cursor), position)
+        self.assertEqual(catalogchanges.decodeCursor(None),
+                         catalogchanges.START)
+        for cursor in ('nonsense', 'MjAxNi0wMS0wMSAwMDowMDowMHwx',
+                       catalogchanges.encodeCursor((1, None, None, None))):
+            self.assertRaises(catalogchanges.CursorError,
+                              catalogchanges.decodeCursor, cursor)
+
+
+if __name__ == '__main__':
+    unittest.main()
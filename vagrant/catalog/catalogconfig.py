@@ -0,0 +1,106 @@
+"""
+Database configuration of the Catalog App.
+
+Everything is read from the environment, so the same code runs on the
+bundled SQLite file, on a tuned WAL mode SQLite or on PostgreSQL.
+"""
+
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+DATABASE_URL = os.environ.get('CATALOG_DATABASE_URL',
+                              'sqlite:///itemcatalog.db')
+
+# Connection pool settings. Every request checks a connection out of this
+# pool through its own session, so the pool size bounds the number of
+# requests that can talk to the database at the same time.
+DB_POOL_SIZE = int(os.environ.get('CATALOG_DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('CATALOG_DB_MAX_OVERFLOW', 20))
+DB_POOL_TIMEOUT = int(os.environ.get('CATALOG_DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('CATALOG_DB_POOL_RECYCLE', 3600))
+
+# SQLite pragmas set on every new connection. WAL lets readers run while
+# a write is in progress; with it, synchronous=NORMAL is still safe
+# against corruption. Empty values leave the SQLite default in place.
+SQLITE_JOURNAL_MODE = os.environ.get('CATALOG_SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.environ.get('CATALOG_SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_CACHE_SIZE = os.environ.get('CATALOG_SQLITE_CACHE_SIZE', '')
+SQLITE_MMAP_SIZE = os.environ.get('CATALOG_SQLITE_MMAP_SIZE', '')
+
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+def sqlitePragmas():
+    """ Returns the configured SQLite pragmas as (name, value) pairs.
+
+    Raises:
+        ValueError: a pragma is set to an invalid value
+    """
+    pragmas = []
+    if SQLITE_JOURNAL_MODE:
+        if SQLITE_JOURNAL_MODE.upper() not in JOURNAL_MODES:
+            raise ValueError('Invalid CATALOG_SQLITE_JOURNAL_MODE: {}'.
+                             format(SQLITE_JOURNAL_MODE))
+        pragmas.append(('journal_mode', SQLITE_JOURNAL_MODE.upper()))
+    if SQLITE_SYNCHRONOUS:
+        if SQLITE_SYNCHRONOUS.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError('Invalid CATALOG_SQLITE_SYNCHRONOUS: {}'.
+                             format(SQLITE_SYNCHRONOUS))
+        pragmas.append(('synchronous', SQLITE_SYNCHRONOUS.upper()))
+    if SQLITE_CACHE_SIZE:
+        pragmas.append(('cache_size', int(SQLITE_CACHE_SIZE)))
+    if SQLITE_MMAP_SIZE:
+        pragmas.append(('mmap_size', int(SQLITE_MMAP_SIZE)))
+    return pragmas
+
+
+def createEngine(url=None):
+    """ Creates an engine for the configured database.
+
+    Args:
+        url: database URL, defaults to CATALOG_DATABASE_URL
+
+    Returns:
+        The engine, with the pool settings applied and, on SQLite, the
+        pragmas set on every connection it opens
+    """
+    url = make_url(url or DATABASE_URL)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(url,
+                             pool_size=DB_POOL_SIZE,
+                             max_overflow=DB_MAX_OVERFLOW,
+                             pool_timeout=DB_POOL_TIMEOUT,
+                             pool_recycle=DB_POOL_RECYCLE,
+                             pool_pre_ping=True)
+
+    if url.database in (None, '', ':memory:'):
+        # Every connection to an in memory database sees a database of
+        # its own, so all of them have to share a single one.
+        engine = create_engine(url,
+                               connect_args={'check_same_thread': False},
+                               poolclass=StaticPool)
+    else:
+        engine = create_engine(url,
+                               connect_args={'check_same_thread': False},
+                               poolclass=QueuePool,
+                               pool_size=DB_POOL_SIZE,
+                               max_overflow=DB_MAX_OVERFLOW,
+                               pool_timeout=DB_POOL_TIMEOUT,
+                               pool_recycle=DB_POOL_RECYCLE,
+                               pool_pre_ping=True)
+
+    pragmas = sqlitePragmas()
+
+    @event.listens_for(engine, 'connect')
+    def setPragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+
+    return engine
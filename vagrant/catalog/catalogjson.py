@@ -0,0 +1,117 @@
+"""
+Fast JSON serialization of the whole catalog.
+
+Only the needed columns are selected with SQLAlchemy Core, so no ORM
+objects are built. Rows come in ordered by category and are grouped in a
+single pass, and each run of items is encoded with one encoder call.
+"""
+
+import itertools
+import json
+import operator
+
+from sqlalchemy import select
+
+from databasemodels import Item
+
+try:
+    import orjson
+
+    def encode(value):
+        return orjson.dumps(value).decode('utf-8')
+except ImportError:
+    encode = json.JSONEncoder().encode
+
+
+# Number of rows fetched from the database (and written to the client)
+# at a time
+BATCH_SIZE = 1000
+
+COLUMNS = [Item.__table__.c.id, Item.__table__.c.title,
+           Item.__table__.c.desc, Item.__table__.c.cat_id]
+
+
+def itemBatches(connection, batchSize=BATCH_SIZE):
+    """ Yields lists of (id, title, desc, cat_id) rows of all items with a
+    category, ordered by cat_id, read from a server side cursor.
+    """
+    items = Item.__table__
+    query = select(COLUMNS).\
+        where(items.c.cat_id.isnot(None)).\
+        order_by(items.c.cat_id, items.c.id)
+    result = connection.execution_options(stream_results=True).\
+        execute(query)
+    while True:
+        rows = result.fetchmany(batchSize)
+        if not rows:
+            break
+        yield rows
+
+
+def itemDict(row):
+    """ Same document as Item.serialize, built from a row """
+    return {
+        "cat_id": row[3],
+        "description": row[2],
+        "id": row[0],
+        "title": row[1]
+    }
+
+
+def categoryHeader(category):
+    return '{{"id": {}, "name": {}, "Items": ['.format(
+        encode(category.id), encode(category.name))
+
+
+def generateCatalogJson(categories, batches):
+    """ Generates the JSON catalog document piece by piece.
+
+    Args:
+        categories: all categories, ordered by id
+        batches: iterable of row lists as yielded by itemBatches(). Items
+            whose category is not in categories are left out.
+
+    Yields:
+        One chunk of the JSON document per batch
+    """
+    pending = iter(categories)
+    current = None
+    opened = 0
+    hasItems = False
+    yield '{"Category": ['
+
+    for batch in batches:
+        chunks = []
+        for cat_id, rows in itertools.groupby(batch,
+                                              operator.itemgetter(3)):
+            while current is None or current.id < cat_id:
+                category = next(pending, None)
+                if category is None:
+                    break
+                if current is not None:
+                    chunks.append(']}')
+                if opened:
+                    chunks.append(', ')
+                chunks.append(categoryHeader(category))
+                opened += 1
+                current = category
+                hasItems = False
+            if current is None or current.id != cat_id:
+                continue
+            if hasItems:
+                chunks.append(', ')
+            chunks.append(encode([itemDict(row) for row in rows])[1:-1])
+            hasItems = True
+        yield ''.join(chunks)
+
+    chunks = []
+    if current is not None:
+        chunks.append(']}')
+    for category in pending:
+        if opened:
+            chunks.append(', ')
+        chunks.append(categoryHeader(category))
+        chunks.append(']}')
+        opened += 1
+    chunks.append(']}')
+    yield ''.join(chunks)
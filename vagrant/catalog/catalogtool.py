@@ -0,0 +1,268 @@
+"""
+Command line tool to bulk load and dump the Catalog.
+
+Records are read and written as JSON lines or CSV with the fields
+category, title, description, user_id and lastupdated. A record without
+a title only declares a category.
+
+Usage:
+    python catalogtool.py import catalog.jsonl
+    python catalogtool.py export --format csv -o catalog.csv
+    python catalogtool.py rebuild-counts
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import sys
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from databasemodels import (CATEGORIES_VERSION, ITEMS_VERSION, Category,
+                            Item, bumpVersions, initDatabase,
+                            rebuildCategoryCounters, updateCategoryCounters)
+
+
+FIELDS = ['category', 'title', 'description', 'user_id', 'lastupdated']
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Rows sent to the database per INSERT statement
+BATCH_SIZE = 5000
+# Rows written per transaction
+TRANSACTION_SIZE = 500000
+
+
+class RecordError(Exception):
+    """ Raised when an input record can't be imported """
+
+
+def readRecords(stream, fileFormat):
+    """ Yields the records of an input file as dicts """
+    if fileFormat == 'csv':
+        for record in csv.DictReader(stream):
+            yield record
+    else:
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as error:
+                raise RecordError('Line {}: {}'.format(number, error))
+
+
+def itemRow(record, cat_id, now):
+    """ Turns an input record into a row of the item table """
+    lastupdated = record.get('lastupdated')
+    if lastupdated:
+        lastupdated = datetime.datetime.strptime(lastupdated, TIME_FORMAT)
+    user_id = record.get('user_id')
+    return {
+        'title': record['title'],
+        'desc': record.get('description'),
+        'cat_id': cat_id,
+        'user_id': int(user_id) if user_id else None,
+        'lastupdated': lastupdated or now,
+    }
+
+
+class Importer(object):
+    """ Loads records into the catalog with batched inserts.
+
+    Categories are created as they are first referenced. Every
+    transaction also bumps the catalog versions, so running apps pick up
+    the new data, and stamps its items with the new items version for the
+    change feed. The categories and items counters only include committed
+    rows.
+    """
+
+    def __init__(self, engine, batchSize=BATCH_SIZE,
+                 transactionSize=TRANSACTION_SIZE):
+        self._engine = engine
+        self._batchSize = batchSize
+        self._transactionSize = transactionSize
+        self.categories = 0
+        self.items = 0
+
+    def _ensureCategories(self, connection, categoryIds, names):
+        table = Category.__table__
+        missing = sorted(set(name for name in names
+                             if name not in categoryIds))
+        if not missing:
+            return 0
+        connection.execute(table.insert(),
+                           [{'name': name} for name in missing])
+        rows = connection.execute(select([table.c.id, table.c.name]).
+                                  where(table.c.name.in_(missing)))
+        categoryIds.update((row.name, row.id) for row in rows)
+        return len(missing)
+
+    def _writeBatch(self, connection, categoryIds, records, changeSeq):
+        names = [record['category'] for record in records]
+        created = self._ensureCategories(connection, categoryIds, names)
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        rows = [itemRow(record, categoryIds[record['category']], now)
+                for record in records if record.get('title')]
+        for row in rows:
+            row['change_seq'] = changeSeq
+        if rows:
+            connection.execute(Item.__table__.insert(), rows)
+            deltas = {}
+            for row in rows:
+                deltas[row['cat_id']] = deltas.get(row['cat_id'], 0) + 1
+            updateCategoryCounters(connection, deltas)
+        return created, len(rows)
+
+    def run(self, records):
+        """ Imports an iterable of records """
+        table = Category.__table__
+        categoryIds = dict(
+            (row.name, row.id) for row in self._engine.execute(
+                select([table.c.id, table.c.name])))
+
+        records = iter(records)
+        done = False
+        while not done:
+            written = 0
+            categories = 0
+            items = 0
+            with self._engine.begin() as connection:
+                changeSeq = None
+                while written < self._transactionSize:
+                    batch = []
+                    for record in records:
+                        if not record.get('category'):
+                            raise RecordError(
+                                'Record without category: {}'.format(record))
+                        batch.append(record)
+                        if len(batch) >= self._batchSize:
+                            break
+                    if not batch:
+                        done = True
+                        break
+                    if changeSeq is None:
+                        changeSeq = bumpVersions(
+                            connection, [ITEMS_VERSION])[ITEMS_VERSION]
+                    created, inserted = self._writeBatch(
+                        connection, categoryIds, batch, changeSeq)
+                    categories += created
+                    items += inserted
+                    written += len(batch)
+                if categories:
+                    bumpVersions(connection, [CATEGORIES_VERSION])
+            self.categories += categories
+            self.items += items
+
+
+def exportRecords(engine, batchSize=BATCH_SIZE):
+    """ Yields all categories and items as records, streaming the items
+    from a server side cursor.
+    """
+    categories = Category.__table__
+    items = Item.__table__
+    names = {}
+    for row in engine.execute(select([categories.c.id, categories.c.name]).
+                              order_by(categories.c.id)):
+        names[row.id] = row.name
+        yield {'category': row.name}
+
+    query = select([items.c.cat_id, items.c.title, items.c.desc,
+                    items.c.user_id, items.c.lastupdated]).\
+        where(items.c.cat_id.isnot(None)).\
+        order_by(items.c.id).\
+        execution_options(stream_results=True)
+    result = engine.execute(query)
+    while True:
+        rows = result.fetchmany(batchSize)
+        if not rows:
+            break
+        for row in rows:
+            yield {
+                'category': names.get(row.cat_id),
+                'title': row.title,
+                'description': row.desc,
+                'user_id': row.user_id,
+                'lastupdated': row.lastupdated.strftime(TIME_FORMAT),
+            }
+
+
+def writeRecords(stream, fileFormat, records):
+    """ Writes records to an output file """
+    if fileFormat == 'csv':
+        writer = csv.DictWriter(stream, FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+    else:
+        for record in records:
+            stream.write(json.dumps(record))
+            stream.write('\n')
+
+
+def guessFormat(path, fileFormat):
+    if fileFormat:
+        return fileFormat
+    return 'csv' if path.endswith('.csv') else 'jsonl'
+
+
+def openFile(path, mode):
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return io.open(stream.fileno(), mode, encoding='utf-8', newline='',
+                       closefd=False)
+    return io.open(path, mode, encoding='utf-8', newline='')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    importer = commands.add_parser('import', help='load records')
+    importer.add_argument('input', help="file to read, '-' for stdin")
+    importer.add_argument('--format', choices=['jsonl', 'csv'])
+    importer.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    importer.add_argument('--transaction-size', type=int,
+                          default=TRANSACTION_SIZE)
+
+    exporter = commands.add_parser('export', help='dump records')
+    exporter.add_argument('-o', '--output', default='-',
+                          help="file to write, '-' for stdout")
+    exporter.add_argument('--format', choices=['jsonl', 'csv'])
+    exporter.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    commands.add_parser('rebuild-counts',
+                        help='recompute the item counts of all categories')
+
+    args = parser.parse_args(argv)
+    engine = initDatabase()
+    if args.command == 'import':
+        job = Importer(engine, args.batch_size, args.transaction_size)
+        with openFile(args.input, 'r') as stream:
+            try:
+                job.run(readRecords(stream,
+                                    guessFormat(args.input, args.format)))
+            except (RecordError, IntegrityError) as error:
+                parser.exit(1, 'Import failed after {} categories and {} '
+                            'items: {}\n'.format(job.categories, job.items,
+                                                  getattr(error, 'orig',
+                                                          error)))
+        print('Imported {} categories and {} items'.format(
+            job.categories, job.items), file=sys.stderr)
+    elif args.command == 'export':
+        with openFile(args.output, 'w') as stream:
+            writeRecords(stream, guessFormat(args.output, args.format),
+                         exportRecords(engine, args.batch_size))
+    else:
+        with engine.begin() as connection:
+            updated = rebuildCategoryCounters(connection)
+            bumpVersions(connection, [ITEMS_VERSION])
+        print('Rebuilt the counts of {} categories'.format(updated),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,34 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.exc import OperationalError, ProgrammingError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy import create_engine, func
+from sqlalchemy.orm import relationship, sessionmaker, Session
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.schema import CreateColumn
 from passlib.apps import custom_app_context as pwd_context
 from sqlalchemy.orm import aliased
 import random
 import string
 import datetime
+import itertools
+import contextlib
+import fcntl
 from itsdangerous import (TimedJSONWebSignatureSerializer as
                           Serializer, BadSignature, SignatureExpired)
 
+from catalogconfig import createEngine
+
 Base = declarative_base()
 secret_key = ''.join(random.choice(string.ascii_uppercase + string.digits)
                      for x in range(32))
 
+# SQLite keeps timestamps as text. CURRENT_TIMESTAMP (used for the server
+# side defaults below) has no fractional seconds, so bound parameters are
+# formatted the same way to keep comparisons against them consistent.
+Timestamp = DateTime().with_variant(sqlite.DATETIME(
+    storage_format="%(year)04d-%(month)02d-%(day)02d "
+                   "%(hour)02d:%(minute)02d:%(second)02d"), 'sqlite')
+
 
 class User(Base):
     __tablename__ = 'user'
@@ -29,6 +44,11 @@ class Category(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(32), nullable=False)
+    # Maintained along with every change to the items of the category,
+    # see updateCategoryCounters()
+    item_count = Column(Integer, nullable=False, default=0,
+                        server_default='0')
+    last_item_update = Column(Timestamp)
 
     @property
     def serialize(self):
@@ -46,20 +66,404 @@ class Item(Base):
     desc = Column(String(250))
     cat_id = Column(Integer, ForeignKey('category.id'))
     category = relationship(Category, backref='items')
-    lastupdated = Column(DateTime, server_default=func.now(),
+    lastupdated = Column(Timestamp, server_default=func.now(),
                          onupdate=func.now(), nullable=False)
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship(User)
+    # Value of the items version counter bumped by the transaction which
+    # last changed the item, see bumpChangedVersions(). Unlike lastupdated
+    # it follows the order the changes were committed in.
+    change_seq = Column(Integer, nullable=False, default=0,
+                        server_default='0')
+
+    # Keyset pagination walks these in (lastupdated, id) order, either over
+    # the whole catalog or within a single category. Item pages address an
+    # item by category and title, which is unique. The change feed reads
+    # items in (change_seq, id) order.
+    __table_args__ = (
+        Index('ix_item_lastupdated_id', 'lastupdated', 'id'),
+        Index('ix_item_cat_id_lastupdated_id', 'cat_id', 'lastupdated', 'id'),
+        Index('ux_item_cat_id_title', 'cat_id', 'title', unique=True),
+        Index('ix_item_change_seq_id', 'change_seq', 'id'),
+    )
 
     @property
     def serialize(self):
         return{
-            "cat_id": self.category.id,
+            "cat_id": self.cat_id,
             "description": self.desc,
             "id": self.id,
             "title": self.title
             }
 
 
-engine = create_engine('sqlite:///itemcatalog.db')
-Base.metadata.create_all(engine)
+class ItemTombstone(Base):
+    """ Record of a deleted item, read by the change feed so that sync
+    clients learn about deletes.
+    """
+    __tablename__ = 'item_tombstone'
+
+    id = Column(Integer, primary_key=True)
+    item_id = Column(Integer, nullable=False)
+    cat_id = Column(Integer)
+    deleted = Column(Timestamp, server_default=func.now(), nullable=False)
+    # Items version counter of the deleting transaction, as on Item
+    change_seq = Column(Integer, nullable=False, default=0,
+                        server_default='0')
+
+    __table_args__ = (
+        Index('ix_item_tombstone_change_seq_id', 'change_seq', 'id'),
+    )
+
+
+class CatalogVersion(Base):
+    """ Version counters of the catalog contents.
+
+    A counter is bumped in the same transaction that changes the data it
+    covers, so caches in any thread or worker process can tell whether
+    what they hold is still current by comparing counters.
+    """
+    __tablename__ = 'catalog_version'
+
+    name = Column(String(32), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+CATEGORIES_VERSION = 'categories'
+ITEMS_VERSION = 'items'
+
+
+def bumpVersions(connection, names):
+    """ Increments the given version counters.
+
+    The counter rows stay locked until the transaction ends, so
+    transactions bumping the same counter get their values in the order
+    they commit.
+
+    Args:
+        connection: connection whose transaction the change belongs to
+        names: names of the counters to increment
+
+    Returns:
+        dict of counter name to its new value
+    """
+    table = CatalogVersion.__table__
+    versions = {}
+    for name in sorted(names):
+        result = connection.execute(table.update().
+                                    where(table.c.name == name).
+                                    values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(name=name, version=1))
+            versions[name] = 1
+        else:
+            versions[name] = connection.execute(
+                select([table.c.version]).where(table.c.name == name)).\
+                scalar()
+    return versions
+
+
+@event.listens_for(Session, 'before_flush')
+def bumpChangedVersions(session, flush_context, instances):
+    """ Bumps the version counters covering the objects being flushed.
+
+    The names of the bumped counters are kept in session.info until the
+    transaction ends, so that local caches can be told after the commit.
+    Created and changed items are stamped with the new items version, and
+    it is kept in session.info for the tombstones of deleted items.
+    """
+    names = set()
+    items = []
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if obj in session.dirty and not session.is_modified(obj):
+            continue
+        if isinstance(obj, Category):
+            names.add(CATEGORIES_VERSION)
+        elif isinstance(obj, Item):
+            names.add(ITEMS_VERSION)
+            if obj not in session.deleted:
+                items.append(obj)
+    if names:
+        versions = bumpVersions(session.connection(), names)
+        session.info.setdefault('bumped_versions', set()).update(names)
+        if ITEMS_VERSION in versions:
+            session.info['item_change_seq'] = versions[ITEMS_VERSION]
+            for obj in items:
+                obj.change_seq = versions[ITEMS_VERSION]
+
+
+@event.listens_for(Session, 'before_flush')
+def recordDeletedItems(session, flush_context, instances):
+    """ Writes a tombstone for every item being deleted, in the same
+    transaction as the delete.
+
+    Runs after bumpChangedVersions(), which was registered first and put
+    the items version of this flush in session.info.
+    """
+    rows = [{'item_id': obj.id, 'cat_id': obj.cat_id,
+             'change_seq': session.info['item_change_seq']}
+            for obj in session.deleted if isinstance(obj, Item)]
+    if rows:
+        session.connection().execute(ItemTombstone.__table__.insert(), rows)
+
+
+def updateCategoryCounters(connection, deltas):
+    """ Adjusts the item counts of categories whose items changed and
+    sets their last item update to now.
+
+    The counts are changed relative to their current value, so concurrent
+    transactions never overwrite each other's changes.
+
+    Args:
+        connection: connection whose transaction the change belongs to
+        deltas: mapping of category id to the number of items added to
+            it, negative for removed items and 0 for changed ones
+    """
+    table = Category.__table__
+    for cat_id, delta in sorted(deltas.items()):
+        connection.execute(table.update().
+                           where(table.c.id == cat_id).
+                           values(item_count=table.c.item_count + delta,
+                                  last_item_update=func.now()))
+
+
+def rebuildCategoryCounters(connection):
+    """ Recomputes the item count and last item update of all
+    categories from the items.
+
+    Deletes leave no trace in the items, so the last item update of a
+    category whose latest change was a delete goes back to its newest
+    remaining item.
+
+    Returns:
+        The number of categories updated
+    """
+    categories = Category.__table__
+    items = Item.__table__
+    ofCategory = items.c.cat_id == categories.c.id
+    result = connection.execute(categories.update().values(
+        item_count=select([func.count()]).where(ofCategory).as_scalar(),
+        last_item_update=select([func.max(items.c.lastupdated)]).
+        where(ofCategory).as_scalar()))
+    return result.rowcount
+
+
+def originalValue(obj, attribute):
+    """ Returns the value an attribute of obj has in the database """
+    history = inspect(obj).attrs[attribute].history
+    original = history.deleted or history.unchanged
+    return original[0] if original else None
+
+
+@event.listens_for(Session, 'before_flush')
+def countCategoryItems(session, flush_context, instances):
+    """ Updates the counters of the categories whose items are being
+    created, changed or deleted, in the same transaction.
+    """
+    deltas = {}
+
+    def count(cat_id, delta):
+        if cat_id is not None:
+            deltas[cat_id] = deltas.get(cat_id, 0) + delta
+
+    for obj in session.new:
+        if isinstance(obj, Item):
+            count(obj.cat_id if obj.cat_id is not None else
+                  getattr(obj.category, 'id', None), 1)
+    for obj in session.deleted:
+        if isinstance(obj, Item):
+            count(originalValue(obj, 'cat_id'), -1)
+    for obj in session.dirty:
+        if isinstance(obj, Item) and session.is_modified(obj):
+            history = inspect(obj).attrs.cat_id.history
+            if history.added:
+                count(originalValue(obj, 'cat_id'), -1)
+                count(history.added[0], 1)
+            else:
+                count(obj.cat_id, 0)
+    if deltas:
+        updateCategoryCounters(session.connection(), deltas)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forgetBumpedVersions(session, previous_transaction):
+    session.info.pop('bumped_versions', None)
+
+
+class SchemaUpgradeError(Exception):
+    """ Raised when an existing database can't be upgraded automatically """
+
+
+def findDuplicates(connection, index):
+    """ Returns the column values which occur more than once in the
+    columns of a unique index, as a list of tuples.
+    """
+    columns = list(index.columns)
+    query = select(columns).group_by(*columns).\
+        having(func.count() > 1)
+    return [tuple(row) for row in connection.execute(query)]
+
+
+def upgradeSchema(engine):
+    """ Brings an existing database up to date with the models.
+
+    Missing tables are created, and columns and indexes declared on the
+    models which are missing in the database are added. create_all()
+    alone skips tables which already exist, so databases created by an
+    older version of the app would never get columns and indexes added
+    later on. Category counters added this way are filled in from the
+    items.
+
+    Raises:
+        SchemaUpgradeError: a unique index can't be created because the
+            data already holds duplicates. These need to be resolved by
+            hand before running the upgrade again.
+    """
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        addedColumns = set()
+        for table in Base.metadata.sorted_tables:
+            existing = set(column['name']
+                           for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in existing:
+                    connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                        engine.dialect.identifier_preparer.format_table(
+                            table),
+                        CreateColumn(column).compile(dialect=engine.dialect)))
+                    addedColumns.add((table.name, column.name))
+        if addedColumns & set([('category', 'item_count'),
+                               ('category', 'last_item_update')]):
+            rebuildCategoryCounters(connection)
+
+        for table in Base.metadata.sorted_tables:
+            existing = set(index['name']
+                           for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                if index.unique:
+                    duplicates = findDuplicates(connection, index)
+                    if duplicates:
+                        raise SchemaUpgradeError(
+                            'Cannot create unique index {} on {}, these '
+                            'values occur more than once: {}'.format(
+                                index.name, table.name, duplicates))
+                index.create(connection)
+
+
+# SQLite FTS5 index over the item titles and descriptions. It is an
+# external content table reading from item, kept in sync by triggers so
+# that every way of writing items (ORM, bulk loads, plain SQL) updates it.
+FULL_TEXT_TABLE = 'item_fts'
+FULL_TEXT_DDL = [
+    '''CREATE VIRTUAL TABLE item_fts USING fts5(
+        title, "desc", content='item', content_rowid='id')''',
+    '''CREATE TRIGGER item_fts_insert AFTER INSERT ON item BEGIN
+        INSERT INTO item_fts(rowid, title, "desc")
+        VALUES (new.id, new.title, new."desc");
+    END''',
+    '''CREATE TRIGGER item_fts_delete AFTER DELETE ON item BEGIN
+        INSERT INTO item_fts(item_fts, rowid, title, "desc")
+        VALUES ('delete', old.id, old.title, old."desc");
+    END''',
+    '''CREATE TRIGGER item_fts_update AFTER UPDATE OF title, "desc" ON item
+    BEGIN
+        INSERT INTO item_fts(item_fts, rowid, title, "desc")
+        VALUES ('delete', old.id, old.title, old."desc");
+        INSERT INTO item_fts(rowid, title, "desc")
+        VALUES (new.id, new.title, new."desc");
+    END''',
+    "INSERT INTO item_fts(item_fts) VALUES ('rebuild')",
+]
+
+
+def hasFullTextSearch(engine):
+    """ Tells whether the database has the item full text index """
+    return FULL_TEXT_TABLE in inspect(engine).get_table_names()
+
+
+def createFullTextIndex(engine):
+    """ Creates and fills the item full text index on SQLite databases
+    which don't have it yet.
+
+    Returns:
+        True if the index exists afterwards. Other databases, and SQLite
+        builds without FTS5, are left without it.
+    """
+    if engine.dialect.name != 'sqlite':
+        return False
+    if hasFullTextSearch(engine):
+        return True
+    try:
+        with engine.begin() as connection:
+            for statement in FULL_TEXT_DDL:
+                connection.execute(statement)
+    except OperationalError:
+        return False
+    return True
+
+
+# Key of the PostgreSQL advisory lock held while the schema is upgraded
+UPGRADE_LOCK_KEY = 0x636174616c6f67
+
+
+@contextlib.contextmanager
+def upgradeLock(engine):
+    """ Holds a lock shared by all processes upgrading the database.
+
+    Every worker upgrades the schema on its first request, and creating
+    tables and indexes checks whether they exist and creates them in two
+    steps, so workers starting together would otherwise race. PostgreSQL
+    databases are locked with an advisory lock, SQLite files with a lock
+    on a file next to them. Other databases are not locked.
+    """
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as connection:
+            connection.execute(
+                select([func.pg_advisory_lock(UPGRADE_LOCK_KEY)]))
+            try:
+                yield
+            finally:
+                connection.execute(
+                    select([func.pg_advisory_unlock(UPGRADE_LOCK_KEY)]))
+    elif engine.dialect.name == 'sqlite' and \
+            engine.url.database not in (None, '', ':memory:'):
+        with open(engine.url.database + '.upgrade-lock', 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+    else:
+        yield
+
+
+def initDatabase(engine=None):
+    """ Creates the database, or upgrades an existing one.
+
+    Safe to run from several processes at once, see upgradeLock(). Where
+    no lock is held (other databases, or a process on another host), an
+    upgrade failing because another process changed the schema at the
+    same time is retried once.
+
+    Args:
+        engine: engine of the database, defaults to the configured one
+
+    Returns:
+        The engine
+    """
+    if engine is None:
+        engine = createEngine()
+    with upgradeLock(engine):
+        try:
+            upgradeSchema(engine)
+        except (OperationalError, ProgrammingError):
+            upgradeSchema(engine)
+        createFullTextIndex(engine)
+    return engine
+
+
+if __name__ == '__main__':
+    initDatabase()
@@ -0,0 +1,181 @@
+"""
+Per request timing and SQL statement instrumentation for the Catalog App
+"""
+
+import json
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, jsonify, make_response, request
+from flask.signals import (before_render_template, signals_available,
+                           template_rendered)
+from sqlalchemy import event
+
+
+requestLog = logging.getLogger('catalog.requests')
+sqlLog = logging.getLogger('catalog.sql')
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+class RouteStats(object):
+    """ Running totals for the requests served by one route """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+        self.statements = 0
+        self.maxStatements = 0
+        self.sqlTime = 0.0
+        self.renderTime = 0.0
+
+    def add(self, metrics, elapsed, failed):
+        self.requests += 1
+        self.errors += 1 if failed else 0
+        self.totalTime += elapsed
+        self.maxTime = max(self.maxTime, elapsed)
+        self.statements += metrics['statements']
+        self.maxStatements = max(self.maxStatements, metrics['statements'])
+        self.sqlTime += metrics['sqlTime']
+        self.renderTime += metrics['renderTime']
+
+    @property
+    def serialize(self):
+        requests = self.requests or 1
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "avg_ms": round(self.totalTime / requests * 1000, 3),
+            "max_ms": round(self.maxTime * 1000, 3),
+            "avg_statements": round(float(self.statements) / requests, 2),
+            "max_statements": self.maxStatements,
+            "avg_sql_ms": round(self.sqlTime / requests * 1000, 3),
+            "avg_render_ms": round(self.renderTime / requests * 1000, 3),
+        }
+
+
+class Instrumentation(object):
+    """ Records latency, SQL statement count and time and template render
+    time of every request, aggregated per route.
+
+    The aggregates are served as JSON on /metrics to local clients only.
+    With logRequests set, every request is also logged as a JSON line on
+    the 'catalog.requests' logger. Statements slower than slowQueryMs are
+    logged on the 'catalog.sql' logger.
+    """
+
+    def __init__(self, app, engine=None, slowQueryMs=100, logRequests=False):
+        self._slowQuery = slowQueryMs / 1000.0
+        self._logRequests = logRequests
+        self._lock = threading.Lock()
+        self._routes = {}
+
+        app.before_request(self._startRequest)
+        app.after_request(self._recordStatus)
+        app.teardown_request(self._endRequest)
+        app.add_url_rule('/metrics', 'metrics', self.metrics)
+
+        if engine is not None:
+            self.watchEngine(engine)
+
+        # Flask only emits signals when blinker is installed, the render
+        # time is left out otherwise.
+        if signals_available:
+            before_render_template.connect(self._startRender, app)
+            template_rendered.connect(self._endRender, app)
+
+    def watchEngine(self, engine):
+        """ Times the statements run on engine """
+        event.listen(engine, 'before_cursor_execute', self._startStatement)
+        event.listen(engine, 'after_cursor_execute', self._endStatement)
+
+    def _startRequest(self):
+        g.metrics = {'start': time.perf_counter(), 'statements': 0,
+                     'sqlTime': 0.0, 'renderTime': 0.0, 'renders': [],
+                     'status': None}
+
+    def _recordStatus(self, response):
+        metrics = g.get('metrics')
+        if metrics is not None:
+            metrics['status'] = response.status_code
+        return response
+
+    def _endRequest(self, exception=None):
+        metrics = g.pop('metrics', None)
+        if metrics is None or request.endpoint == 'metrics':
+            return
+        elapsed = time.perf_counter() - metrics['start']
+        status = 500 if exception is not None else metrics['status']
+        route = request.endpoint or '<unmatched>'
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = RouteStats()
+            stats.add(metrics, elapsed, status is None or status >= 500)
+
+        if self._logRequests:
+            requestLog.info(json.dumps({
+                "route": route,
+                "method": request.method,
+                "path": request.path,
+                "status": status,
+                "ms": round(elapsed * 1000, 3),
+                "statements": metrics['statements'],
+                "sql_ms": round(metrics['sqlTime'] * 1000, 3),
+                "render_ms": round(metrics['renderTime'] * 1000, 3),
+            }))
+
+    def _startStatement(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        # A connection runs one statement at a time, so a single slot is
+        # enough. It is overwritten by the next statement when this one
+        # fails, as after_cursor_execute only fires on success.
+        conn.info['statement_start'] = time.perf_counter()
+
+    def _endStatement(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        elapsed = time.perf_counter() - conn.info.pop('statement_start')
+        if has_request_context():
+            metrics = g.get('metrics')
+            if metrics is not None:
+                metrics['statements'] += 1
+                metrics['sqlTime'] += elapsed
+        if elapsed >= self._slowQuery:
+            sqlLog.warning(json.dumps({
+                "route": request.endpoint if has_request_context() else None,
+                "ms": round(elapsed * 1000, 3),
+                "statement": statement,
+            }))
+
+    def _startRender(self, app, template, context):
+        metrics = g.get('metrics')
+        if metrics is not None:
+            metrics['renders'].append(time.perf_counter())
+
+    def _endRender(self, app, template, context):
+        metrics = g.get('metrics')
+        if metrics is not None and metrics['renders']:
+            elapsed = time.perf_counter() - metrics['renders'].pop()
+            # Fragments rendered while another template renders are
+            # already part of the outer render time.
+            if not metrics['renders']:
+                metrics['renderTime'] += elapsed
+
+    def metrics(self):
+        """ JSON endpoint returning the aggregated metrics per route
+
+        Returns:
+            on GET:
+                Metrics per route, 404 for non local clients
+        """
+        if request.remote_addr not in LOCAL_ADDRESSES:
+            response = make_response(json.dumps('Not found'), 404)
+            response.headers['Content-type'] = 'application/json'
+            return response
+        with self._lock:
+            routes = dict((route, stats.serialize)
+                          for route, stats in self._routes.items())
+        return jsonify(routes=routes)
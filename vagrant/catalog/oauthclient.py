@@ -0,0 +1,149 @@
+"""
+Client for the Google OAuth endpoints used to sign users in and out.
+
+All calls share pooled keep-alive connections and are bounded by a
+timeout. The endpoint URLs can be pointed at a local stub server through
+the environment.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+import requests
+from oauth2client.client import OAuth2WebServerFlow
+from requests.adapters import HTTPAdapter
+
+from catalogcache import LRUCache
+
+
+TOKEN_URI = os.environ.get('CATALOG_OAUTH_TOKEN_URI')
+TOKENINFO_URL = os.environ.get(
+    'CATALOG_OAUTH_TOKENINFO_URL',
+    'https://www.googleapis.com/oauth2/v1/tokeninfo')
+USERINFO_URL = os.environ.get(
+    'CATALOG_OAUTH_USERINFO_URL',
+    'https://www.googleapis.com/oauth2/v2/userinfo')
+REVOKE_URL = os.environ.get(
+    'CATALOG_OAUTH_REVOKE_URL',
+    'https://accounts.google.com/o/oauth2/revoke')
+
+# Seconds to wait for any single call to the OAuth provider
+HTTP_TIMEOUT = float(os.environ.get('CATALOG_OAUTH_TIMEOUT', 5))
+# Connections kept alive per OAuth host
+HTTP_POOL_SIZE = int(os.environ.get('CATALOG_OAUTH_POOL_SIZE', 10))
+# Seconds for which a successful tokeninfo answer is reused
+TOKENINFO_TTL = float(os.environ.get('CATALOG_OAUTH_TOKENINFO_TTL', 60))
+
+
+class OAuthError(Exception):
+    """ Raised when the OAuth provider can't be reached or answers with
+    something other than a JSON document
+    """
+
+
+class OAuthClient(object):
+    """ Talks to the OAuth provider on behalf of the login routes.
+
+    An instance is shared by all request threads.
+    """
+
+    def __init__(self, clientSecretsFile, timeout=HTTP_TIMEOUT,
+                 poolSize=HTTP_POOL_SIZE, tokeninfoTtl=TOKENINFO_TTL):
+        with open(clientSecretsFile, 'r') as secrets:
+            self._secrets = json.load(secrets)['web']
+        self._timeout = timeout
+        self._tokeninfoTtl = tokeninfoTtl
+        self._tokeninfoCache = LRUCache(1024)
+
+        self._http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=poolSize,
+                              pool_maxsize=poolSize)
+        self._http.mount('https://', adapter)
+        self._http.mount('http://', adapter)
+        # httplib2 connections can't be shared between threads, so the code
+        # exchange keeps one per thread.
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=poolSize)
+
+    @property
+    def clientId(self):
+        return self._secrets['client_id']
+
+    def _getJson(self, url, params):
+        try:
+            response = self._http.get(url, params=params,
+                                      timeout=self._timeout)
+            return response.json()
+        except (requests.RequestException, ValueError) as error:
+            raise OAuthError(str(error))
+
+    def exchange(self, code):
+        """ Upgrades a one time authorization code into credentials.
+
+        Raises:
+            oauth2client.client.FlowExchangeError: the code was rejected
+        """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = httplib2.Http(timeout=self._timeout)
+            self._local.http = http
+        flow = OAuth2WebServerFlow(
+            self._secrets['client_id'],
+            client_secret=self._secrets['client_secret'],
+            scope='',
+            redirect_uri='postmessage',
+            auth_uri=self._secrets['auth_uri'],
+            token_uri=TOKEN_URI or self._secrets['token_uri'])
+        return flow.step2_exchange(code, http=http)
+
+    def tokeninfo(self, access_token):
+        """ Returns what the provider knows about an access token.
+
+        Successful answers are cached for a short while, so repeated
+        logins with the same token don't go out to the provider again.
+        """
+        cached = self._tokeninfoCache.get(access_token)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        result = self._getJson(TOKENINFO_URL,
+                               {'access_token': access_token})
+        if result.get('error') is None:
+            self._tokeninfoCache.set(
+                access_token,
+                (time.monotonic() + self._tokeninfoTtl, result))
+        return result
+
+    def userinfo(self, access_token):
+        """ Returns the profile of the user owning an access token """
+        return self._getJson(USERINFO_URL,
+                             {'access_token': access_token, 'alt': 'json'})
+
+    def verify(self, access_token):
+        """ Looks up tokeninfo and userinfo of an access token concurrently.
+
+        Returns:
+            (tokeninfo, userinfo) tuple. userinfo is a future, its result
+            only needs to be waited for once tokeninfo has been checked.
+        """
+        userinfo = self._executor.submit(self.userinfo, access_token)
+        return self.tokeninfo(access_token), userinfo
+
+    def revoke(self, access_token):
+        """ Revokes an access token.
+
+        Returns:
+            True if the provider confirmed the revocation
+        """
+        self._tokeninfoCache.delete(access_token)
+        try:
+            response = self._http.get(REVOKE_URL,
+                                      params={'token': access_token},
+                                      timeout=self._timeout)
+        except requests.RequestException as error:
+            raise OAuthError(str(error))
+        return response.status_code == 200
@@ -0,0 +1,193 @@
+"""
+Server side session storage for the Catalog App.
+
+Only a random session id travels in the cookie, the session data stays
+on the server. The cookie is sent once, when the session is created, so
+requests which don't change the session leave the response untouched.
+"""
+
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from catalogcache import LRUCache
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """ Session data stored under a session id """
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def onUpdate(session):
+            session.modified = True
+        CallbackDict.__init__(self, initial, onUpdate)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.replacedSid = None
+
+    def regenerate(self):
+        """ Moves the session data to a new session id. The old id is
+        dropped from the store when the session is saved.
+        """
+        if not self.new:
+            self.replacedSid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+
+
+class MemoryStore(object):
+    """ Sessions kept in the memory of a single process.
+
+    Once maxsize sessions are held the least recently used one is
+    dropped.
+    """
+
+    def __init__(self, maxsize=10000):
+        self._sessions = LRUCache(maxsize)
+
+    def get(self, sid):
+        entry = self._sessions.get(sid)
+        if entry is None or entry[0] < time.time():
+            return None
+        return dict(entry[1])
+
+    def set(self, sid, data, expires):
+        self._sessions.set(sid, (expires, dict(data)))
+
+    def delete(self, sid):
+        self._sessions.delete(sid)
+
+
+class SqliteStore(object):
+    """ Sessions kept in an SQLite file, shared by all worker processes on
+    a host.
+    """
+
+    # Expired sessions are purged on roughly one write out of this many
+    PURGE_EVERY = 1000
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS session ('
+                               'sid TEXT PRIMARY KEY, '
+                               'data TEXT NOT NULL, '
+                               'expires REAL NOT NULL)')
+
+    def _connection(self):
+        # A connection per thread, opened again after a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self._path, timeout=10)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, sid):
+        row = self._connection().execute(
+            'SELECT data FROM session WHERE sid = ? AND expires >= ?',
+            (sid, time.time())).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set(self, sid, data, expires):
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO session (sid, data, expires) '
+                'VALUES (?, ?, ?)', (sid, json.dumps(data), expires))
+            if secrets.randbelow(self.PURGE_EVERY) == 0:
+                connection.execute('DELETE FROM session WHERE expires < ?',
+                                   (time.time(),))
+
+    def delete(self, sid):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM session WHERE sid = ?', (sid,))
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """ Flask session interface keeping session data in a store
+
+    Sessions holding nothing but the keys in anonymousKeys, such as the
+    CSRF state token every page view creates, are stored for
+    anonymousLifetime seconds only, so clients which never come back
+    (crawlers, health checks) don't keep a session for the full
+    permanent_session_lifetime.
+    """
+
+    def __init__(self, store, anonymousLifetime=3600,
+                 anonymousKeys=('state',)):
+        self._store = store
+        self._anonymousLifetime = anonymousLifetime
+        self._anonymousKeys = frozenset(anonymousKeys)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            data = self._store.get(sid)
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.replacedSid is not None:
+            self._store.delete(session.replacedSid)
+        if not session:
+            if session.modified and not session.new:
+                self._store.delete(session.sid)
+            if session.modified and (not session.new or
+                                     session.replacedSid is not None):
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        if session.modified or session.new:
+            if self._anonymousKeys.issuperset(session):
+                lifetime = self._anonymousLifetime
+            else:
+                lifetime = app.permanent_session_lifetime.total_seconds()
+            self._store.set(session.sid, dict(session), time.time() + lifetime)
+        if session.new:
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=self.get_expiration_time(app,
+                                                                 session),
+                                httponly=self.get_cookie_httponly(app),
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app),
+                                domain=domain, path=path)
+
+
+def createSessionInterface(backend, path=None, maxsize=10000,
+                           anonymousLifetime=3600):
+    """ Returns the session interface for a backend name.
+
+    Args:
+        backend: 'cookie' for Flask's signed cookie sessions, 'memory' or
+            'sqlite' for server side sessions
+        path: SQLite file of the 'sqlite' backend
+        maxsize: maximum number of sessions of the 'memory' backend
+        anonymousLifetime: seconds for which sessions holding only a CSRF
+            state token are kept by the server side backends
+
+    Returns:
+        The session interface, None for 'cookie'
+    """
+    if backend == 'cookie':
+        return None
+    if backend == 'memory':
+        return ServerSideSessionInterface(MemoryStore(maxsize),
+                                          anonymousLifetime)
+    if backend == 'sqlite':
+        return ServerSideSessionInterface(SqliteStore(path),
+                                          anonymousLifetime)
+    raise ValueError('Unknown session backend: {}'.format(backend))
@@ -2,46 +2,205 @@
 Main module which contains various routes for the Catalog App
 """
 
+import base64
+import binascii
+import datetime
+import hashlib
 import json
 import os
-import random
-import string
+import secrets
+import threading
 
-import httplib2
-import requests
-from flask import (Flask, abort, flash, g, jsonify, make_response,
-                   render_template, request)
+from flask import (Flask, Markup, Response, abort, flash, g, jsonify,
+                   make_response, render_template, request,
+                   stream_with_context)
 from flask import session as login_session
 from flask_httpauth import HTTPBasicAuth
-from oauth2client.client import FlowExchangeError, flow_from_clientsecrets
-from sqlalchemy import create_engine
+from oauth2client.client import FlowExchangeError
+from sqlalchemy import func, or_, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker, joinedload
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
 
-from databasemodels import Base, Category, Item, User
+from catalogassets import Assets
+from catalogconfig import createEngine
+from catalogcache import CatalogVersions, CategoryRegistry, LRUCache
+import catalogchanges
+from catalogjson import generateCatalogJson, itemBatches
+from databasemodels import (CATEGORIES_VERSION, ITEMS_VERSION, Category,
+                            Item, User, hasFullTextSearch, initDatabase)
+from instrumentation import Instrumentation
+from oauthclient import OAuthClient, OAuthError
+from sessionstore import createSessionInterface
 
 
-CLIENT_ID = json.loads(
-    open('client_secret.json', 'r').read())['web']['client_id']
 APPLICATION_NAME = "Catalog App"
+CLIENT_SECRETS_FILE = 'client_secret.json'
 
 auth = HTTPBasicAuth()
 
 g_app = Flask(__name__)
-g_app.secret_key = os.urandom(24)
+# Set a fixed key when more than one worker process serves the app, or
+# sessions signed by one of them are rejected by the others.
+g_app.secret_key = os.environ.get('CATALOG_SECRET_KEY') or os.urandom(24)
+
+# Where session data is kept: 'cookie' keeps it in the signed session
+# cookie, 'memory' in the memory of the process (a single worker only) and
+# 'sqlite' in SESSION_FILE, shared by the workers on a host. With the
+# server side backends the cookie only carries a session id and is sent
+# once, when the session starts.
+SESSION_BACKEND = os.environ.get('CATALOG_SESSION_BACKEND', 'cookie')
+SESSION_FILE = os.environ.get('CATALOG_SESSION_FILE', 'sessions.db')
+SESSION_CACHE_SIZE = int(os.environ.get('CATALOG_SESSION_CACHE_SIZE', 10000))
+# Seconds for which the server side backends keep sessions of visitors
+# who never signed in, which only hold the CSRF state token
+ANONYMOUS_SESSION_LIFETIME = int(
+    os.environ.get('CATALOG_ANONYMOUS_SESSION_LIFETIME', 3600))
+
+g_sessionInterface = createSessionInterface(
+    SESSION_BACKEND, path=SESSION_FILE, maxsize=SESSION_CACHE_SIZE,
+    anonymousLifetime=ANONYMOUS_SESSION_LIFETIME)
+if g_sessionInterface is not None:
+    g_app.session_interface = g_sessionInterface
+
+# Number of items shown per page on the listing pages
+ITEMS_PER_PAGE = int(os.environ.get('CATALOG_ITEMS_PER_PAGE', 20))
+MAX_ITEMS_PER_PAGE = 100
+CURSOR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Seconds for which the catalog version counters are trusted before they
+# are read again. Changes made by other worker processes show up after at
+# most this long.
+CATALOG_VERSION_TTL = float(os.environ.get('CATALOG_VERSION_TTL', 1))
+
+# Number of rendered page fragments kept in memory by every worker
+FRAGMENT_CACHE_SIZE = int(os.environ.get('CATALOG_FRAGMENT_CACHE_SIZE', 512))
+
+# Changes returned per call of the change feed
+CHANGES_PER_PAGE = 100
+MAX_CHANGES_PER_PAGE = 1000
+
+# Operations accepted per call of the batch endpoint, and ids looked up
+# per query while checking them
+MAX_BATCH_ITEMS = 1000
+BATCH_QUERY_SIZE = 500
+
+# Search results can be paged through up to this page
+SEARCH_MAX_PAGES = 50
+
+# Statements taking longer than this many milliseconds are logged
+SLOW_QUERY_MS = float(os.environ.get('CATALOG_SLOW_QUERY_MS', 100))
+# Log every request as a JSON line with its timings
+LOG_REQUESTS = os.environ.get('CATALOG_LOG_REQUESTS', '') == '1'
+
+# Create missing tables and indexes when a process first uses the
+# database. Set to 0 when the schema is kept up to date by running
+# python databasemodels.py on deployment instead.
+UPGRADE_SCHEMA = os.environ.get('CATALOG_UPGRADE_SCHEMA', '1') == '1'
+
+# Sessions are bound to the engine once it is created, see
+# ensureResources()
+DBSession = sessionmaker()
+
+# Thread local session registry. Each request gets its own session (and
+# identity map) on first use, which is closed in shutdownSession() once the
+# request is over.
+g_session = scoped_session(DBSession)
+
+# Created by ensureResources() on the first request of every process, so
+# importing this module neither touches the database nor reads
+# client_secret.json, and worker processes forked after the import each
+# open connections of their own.
+g_engine = None
+g_oauth = None
+g_versions = None
+g_categoryRegistry = None
+g_fullTextSearch = False
+g_pid = None
+g_resourcesLock = threading.Lock()
+g_templatesDigest = None
+
+g_fragmentCache = LRUCache(FRAGMENT_CACHE_SIZE)
+g_assets = Assets(g_app)
+g_instrumentation = Instrumentation(g_app,
+                                   slowQueryMs=SLOW_QUERY_MS,
+                                   logRequests=LOG_REQUESTS)
+
+
+def create_app(databaseUrl=None, upgradeSchema=None):
+    """ Returns the Catalog App, for WSGI servers and the flask command.
+
+    This is cheap: nothing is connected until the app serves its first
+    request.
 
-# Connect to Database and create database session
-g_engine = create_engine('sqlite:///itemcatalog.db',
-                         connect_args={'check_same_thread': False})
-Base.metadata.bind = g_engine
+    Args:
+        databaseUrl: URL of the database, defaults to CATALOG_DATABASE_URL
+        upgradeSchema: create or upgrade the database schema when the
+            database is first used, defaults to CATALOG_UPGRADE_SCHEMA
+
+    Returns:
+        The app
+    """
+    g_app.config['CATALOG_DATABASE_URL'] = databaseUrl
+    if upgradeSchema is not None:
+        g_app.config['CATALOG_UPGRADE_SCHEMA'] = upgradeSchema
+    return g_app
 
-DBSession = sessionmaker(bind=g_engine)
-g_session = DBSession()
 
-global g_authenticated
-g_authenticated = False
+@g_app.before_request
+def ensureResources():
+    """ Sets up the database engine and the caches of this process.
 
-g_categories = g_session.query(Category).all()
+    Runs before every request and does nothing once the current process
+    is set up. A process forked after the setup (e.g. by a pre-loading
+    server) drops the connections it inherited and opens new ones.
+    """
+    global g_engine, g_versions, g_categoryRegistry, g_fullTextSearch
+    global g_oauth, g_pid
+    pid = os.getpid()
+    if g_pid == pid:
+        return
+    with g_resourcesLock:
+        if g_pid == pid:
+            return
+        if g_engine is None:
+            engine = createEngine(g_app.config.get('CATALOG_DATABASE_URL'))
+            if g_app.config.get('CATALOG_UPGRADE_SCHEMA', UPGRADE_SCHEMA):
+                initDatabase(engine)
+            DBSession.configure(bind=engine)
+            g_versions = CatalogVersions(engine, ttl=CATALOG_VERSION_TTL)
+            g_versions.watch(DBSession)
+            g_categoryRegistry = CategoryRegistry(engine, g_versions)
+            g_instrumentation.watchEngine(engine)
+            g_fullTextSearch = hasFullTextSearch(engine)
+            g_engine = engine
+        else:
+            g_engine.dispose()
+        # The OAuth client keeps connections alive, so a forked process
+        # needs its own as well. It is created on first use.
+        g_oauth = None
+        g_pid = pid
+
+
+def oauthClient():
+    """ Returns the OAuth client of this process """
+    global g_oauth
+    with g_resourcesLock:
+        if g_oauth is None:
+            g_oauth = OAuthClient(CLIENT_SECRETS_FILE)
+        return g_oauth
+
+
+@g_app.teardown_appcontext
+def shutdownSession(exception=None):
+    """ Releases the session of the current request.
+
+    Any transaction left open by a failed request is rolled back so that
+    the connection goes back to the pool in a clean state.
+    """
+    if exception is not None:
+        g_session.rollback()
+    g_session.remove()
 
 
 @auth.verify_password
@@ -52,14 +211,326 @@ def verify_password(username_or_token, password):
         return True
 
 
-def refreshState():
-    """ This method refereshes the state token value.
+def isAuthenticated():
+    """ Returns True when a user is signed in on the current session """
+    return 'username' in login_session
+
+
+def ensureState():
+    """ Returns the state token of the session, creating it if needed.
     This state is used to prevent CSRF.
+
+    The token is kept for the whole session, so pages which only read
+    leave the session untouched. It is replaced by rotateState() after
+    every request that changes something.
+    """
+    if 'state' not in login_session:
+        rotateState()
+    return login_session['state']
+
+
+def rotateState():
+    """ Replaces the state token of the session with a new one """
+    login_session['state'] = secrets.token_hex(16)
+
+
+def regenerateSession():
+    """ Moves the session to a new session id. Called when the user signs
+    in or out, so that a session id planted in the browser beforehand
+    can't be used to ride on the signed in session.
+
+    Sessions kept in the signed cookie have no id and are left as they
+    are.
+    """
+    regenerate = getattr(login_session, 'regenerate', None)
+    if regenerate is not None:
+        regenerate()
+
+
+def isValidState(state):
+    """ Checks a state token sent by the client against the session """
+    stored = login_session.get('state')
+    return stored is not None and state is not None and \
+        secrets.compare_digest(str(state), stored)
+
+
+def encodeCursor(item):
+    """ Encodes the position of an item in the listing order.
+
+    Args:
+        item: Item the cursor points at
+
+    Returns:
+        An opaque, url safe cursor string
+    """
+    position = '{}|{}'.format(item.lastupdated.strftime(CURSOR_TIME_FORMAT),
+                              item.id)
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decodeCursor(cursor):
+    """ Decodes a cursor created by encodeCursor()
+
+    Args:
+        cursor: cursor string received from the client
+
+    Returns:
+        (lastupdated, id) tuple, or None if no cursor was given.
+        Malformed cursors abort the request with 400.
+    """
+    if not cursor:
+        return None
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode()).decode()
+        lastupdated, item_id = position.split('|')
+        return (datetime.datetime.strptime(lastupdated, CURSOR_TIME_FORMAT),
+                int(item_id))
+    except (binascii.Error, UnicodeError, ValueError):
+        abort(400)
+
+
+def paginateItems(query):
+    """ Returns one page of items, newest first, using keyset pagination.
+
+    The page is located with the 'after' or 'before' cursor in the request
+    arguments, so every page costs the same regardless of how deep into the
+    listing it is.
+
+    Args:
+        query: Item query to paginate
+
+    Returns:
+        (items, nextCursor, prevCursor) tuple. A cursor is None when there
+        is no page in that direction.
+    """
+    size = request.args.get('size', ITEMS_PER_PAGE, type=int)
+    size = max(1, min(size, MAX_ITEMS_PER_PAGE))
+    after = decodeCursor(request.args.get('after'))
+    before = decodeCursor(request.args.get('before'))
+
+    if before is not None:
+        lastupdated, item_id = before
+        rows = query.filter(Item.lastupdated >= lastupdated).\
+            filter(or_(Item.lastupdated > lastupdated,
+                       Item.id > item_id)).\
+            order_by(Item.lastupdated.asc(), Item.id.asc()).\
+            limit(size + 1).all()
+        hasPrev = len(rows) > size
+        items = list(reversed(rows[:size]))
+        hasNext = True
+    else:
+        if after is not None:
+            lastupdated, item_id = after
+            query = query.filter(Item.lastupdated <= lastupdated).\
+                filter(or_(Item.lastupdated < lastupdated,
+                           Item.id < item_id))
+        rows = query.order_by(Item.lastupdated.desc(), Item.id.desc()).\
+            limit(size + 1).all()
+        hasNext = len(rows) > size
+        items = rows[:size]
+        hasPrev = after is not None
+
+    if not items:
+        return items, None, None
+    nextCursor = encodeCursor(items[-1]) if hasNext else None
+    prevCursor = encodeCursor(items[0]) if hasPrev else None
+    return items, nextCursor, prevCursor
+
+
+def findItemByTitle(item_title):
+    """ Looks an item up through the (cat_id, title) index.
+
+    The category is taken from the 'cat_id' request argument. Links
+    without it are resolved by probing the index once per category.
+
+    Args:
+        item_title: title of the item
+
+    Returns:
+        The item, or None if there is no such item
+    """
+    query = g_session.query(Item).filter(Item.title == item_title)
+    cat_id = request.args.get('cat_id', type=int)
+    if cat_id is not None:
+        query = query.filter(Item.cat_id == cat_id)
+    else:
+        query = query.filter(Item.cat_id.in_(
+            [category.id for category in g_categoryRegistry.all()]))
+    return query.first()
+
+
+def itemExistsResponse():
+    """ Response for an item title which is already taken """
+    response = make_response(
+        json.dumps('An item with this title already exists '
+                   'in the category'), 409)
+    response.headers['Content-type'] = 'application/json'
+    return response
+
+
+def templatesDigest():
+    """ Returns a digest of the templates and the built assets, so the
+    ETags of pages change when a new version of the app is deployed.
+    """
+    global g_templatesDigest
+    if g_templatesDigest is None:
+        digest = hashlib.sha1()
+        templates = os.path.join(g_app.root_path, g_app.template_folder)
+        paths = [os.path.join(templates, name)
+                 for name in sorted(os.listdir(templates))]
+        paths.append(os.path.join(g_app.static_folder, 'dist',
+                                  'manifest.json'))
+        for path in paths:
+            if os.path.isfile(path):
+                with open(path, 'rb') as source:
+                    digest.update(source.read())
+        g_templatesDigest = digest.hexdigest()
+    return g_templatesDigest
+
+
+def pageEtag(*parts):
+    """ Returns the ETag of a page showing data identified by parts.
+
+    Pages also show who is signed in and embed the state token, so these
+    are part of every ETag.
+    """
+    key = (templatesDigest(), login_session.get('user_id'),
+           ensureState()) + parts
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def notModifiedResponse(etag):
+    """ Returns an empty 304 response if the client holds the page with
+    the given ETag, None otherwise.
+    """
+    if not request.if_none_match.contains(etag):
+        return None
+    response = make_response('', 304)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditionalPage(page, etag, lastModified):
+    """ Makes a response for a rendered page which clients may keep but
+    have to revalidate before each use.
+
+    Args:
+        page: rendered page
+        etag: ETag of the page, from pageEtag()
+        lastModified: time the data shown last changed, None if unknown
+    """
+    response = make_response(page)
+    response.set_etag(etag)
+    if lastModified is not None:
+        response.last_modified = lastModified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def cachedFragment(key, render):
+    """ Returns a rendered page fragment, rendering it only on a miss.
+
+    Args:
+        key: cache key. It has to hold the catalog versions and request
+            arguments the fragment depends on.
+        render: function rendering the fragment, including any queries
+            needed for it
+
+    Returns:
+        The fragment as safe markup
     """
-    global login_session
-    state = ''.join(random.choice(string.ascii_uppercase + string.digits)
-                    for x in range(32))
-    login_session['state'] = state
+    fragment = g_fragmentCache.get(key)
+    if fragment is None:
+        fragment = Markup(render())
+        g_fragmentCache.set(key, fragment)
+    return fragment
+
+
+def categoriesFragment():
+    """ Returns the rendered category sidebar """
+    def render():
+        counts = dict(g_session.query(Category.id, Category.item_count))
+        return render_template('_categories.html',
+                               categories=g_categoryRegistry.all(),
+                               counts=counts)
+
+    return cachedFragment(
+        ('categories', g_versions.get(CATEGORIES_VERSION),
+         g_versions.get(ITEMS_VERSION)),
+        render)
+
+
+def itemsFragment(query, itemsHeading, showCategory, cat_id=None):
+    """ Returns a rendered page of the item listing.
+
+    Args:
+        query: Item query to list
+        itemsHeading: heading shown above the items
+        showCategory: whether the category is shown next to each item
+        cat_id: id of the category the query is restricted to, if any
+    """
+    def render():
+        items, nextCursor, prevCursor = paginateItems(query)
+        return render_template('_items.html',
+                               items=items,
+                               nextCursor=nextCursor,
+                               prevCursor=prevCursor,
+                               categoryById=g_categoryRegistry.byId,
+                               showCategory=showCategory,
+                               itemsHeading=itemsHeading)
+
+    key = ('items', cat_id,
+           request.args.get('after'), request.args.get('before'),
+           request.args.get('size'),
+           g_versions.get(ITEMS_VERSION), g_versions.get(CATEGORIES_VERSION))
+    return cachedFragment(key, render)
+
+
+def fullTextQuery(terms):
+    """ Builds an FTS5 query matching items containing all the words of
+    the search terms, the last one as a prefix.
+
+    Every word is quoted, so characters with a meaning in the FTS5 query
+    syntax are searched for literally.
+    """
+    phrases = ['"{}"'.format(word.replace('"', '""'))
+               for word in terms.split()]
+    phrases[-1] += '*'
+    return ' '.join(phrases)
+
+
+def searchItems(terms, page, size):
+    """ Returns a page of the items matching the search terms.
+
+    Items are ranked by relevance with matches in the title counting more
+    than matches in the description. Databases without the full text
+    index fall back to a substring search ordered by modification time.
+
+    Returns:
+        (items, hasNext) tuple
+    """
+    offset = (page - 1) * size
+    if g_fullTextSearch:
+        items = g_session.execute(text(
+            'SELECT item.id, item.title, item.cat_id '
+            'FROM item_fts JOIN item ON item.id = item_fts.rowid '
+            'WHERE item_fts MATCH :query '
+            'ORDER BY bm25(item_fts, 10.0, 1.0) '
+            'LIMIT :limit OFFSET :offset'),
+            {'query': fullTextQuery(terms), 'limit': size + 1,
+             'offset': offset}).fetchall()
+    else:
+        pattern = '%{}%'.format(terms.replace('\\', '\\\\').
+                                replace('%', '\\%').replace('_', '\\_'))
+        items = g_session.query(Item.id, Item.title, Item.cat_id).\
+            filter(or_(Item.title.ilike(pattern, escape='\\'),
+                       Item.desc.ilike(pattern, escape='\\'))).\
+            order_by(Item.lastupdated.desc(), Item.id.desc()).\
+            limit(size + 1).offset(offset).all()
+    return items[:size], len(items) > size
 
 
 @g_app.route('/', methods=['GET'])
@@ -67,30 +538,24 @@ def home():
     """ This is the landing page
 
     Returns:
-    on GET: List all the available Catagories and latest modified items.
+    on GET: List all the available Catagories and a page of the latest
+    modified items.
     """
 
-    items = g_session.query(Item).order_by(Item.lastupdated.desc()).all()
-    global g_authenticated
-    if 'username' not in login_session:
-        g_authenticated = False
-    else:
-        g_authenticated = True
-
-    refreshState()
     return render_template('index.html',
-                           STATE=login_session['state'],
-                           categories=g_categories,
-                           items=items,
-                           authenticated=g_authenticated,
-                           itemsHeading="Latest Items")
+                           STATE=ensureState(),
+                           categoriesFragment=categoriesFragment(),
+                           itemsFragment=itemsFragment(
+                               g_session.query(Item), "Latest Items",
+                               showCategory=True),
+                           authenticated=isAuthenticated())
 
 
 @g_app.route('/oauth/google', methods=['POST'])
 def gconnect():
     """ This method gets called once the user is authenticated by Google
     """
-    if request.args.get('state') != login_session['state']:
+    if not isValidState(request.args.get('state')):
         response = make_response(json.dumps('Unauthorized!!!'), 401)
         response.headers['Content-type'] = 'application/json'
         return response
@@ -98,19 +563,22 @@ def gconnect():
     oauth_code = request.data
 
     try:
-        oauth_flow = flow_from_clientsecrets('client_secret.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(oauth_code)
+        credentials = oauthClient().exchange(oauth_code)
     except FlowExchangeError:
         response = make_response(json.dumps(
             'Failed to upgrade auth code'), 401)
         response.headers['Content-type'] = 'application/json'
+        return response
 
     access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s' %
-           access_token)
-    http_obj = httplib2.Http()
-    result = json.loads(http_obj.request(url, 'GET')[1])
+    try:
+        result, userinfo = oauthClient().verify(access_token)
+    except OAuthError:
+        response = make_response(json.dumps(
+            'Failed to verify the access token'), 502)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
     if result.get('error') is not None:
         response = make_response(json.dumps(result.get('error')), 500)
         response.headers['Content-Type'] = 'application/json'
@@ -131,21 +599,23 @@ def gconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    if result['issued_to'] != CLIENT_ID:
+    if result['issued_to'] != oauthClient().clientId:
         response = make_response(
             json.dumps("Token's client ID does not match app's."), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
 
+    try:
+        data = userinfo.result()
+    except OAuthError:
+        response = make_response(json.dumps(
+            'Failed to fetch the user profile'), 502)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
     login_session['access_token'] = credentials.access_token
     login_session['google_id'] = google_id
 
-    userinfo_url = "https://www.googleapis.com/oauth2/v2/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
-
     login_session['username'] = data['name']
     login_session['picture'] = data['picture']
     login_session['email'] = data['email']
@@ -161,9 +631,8 @@ def gconnect():
     g_session.refresh(user)
 
     login_session['user_id'] = user.id
-
-    global g_authenticated
-    g_authenticated = True
+    regenerateSession()
+    rotateState()
 
     return json.dumps({'name': login_session['username']})
 
@@ -183,22 +652,21 @@ def gdisconnect():
     print('In gdisconnect access token is %s', access_token)
     print('User name is: ')
     print(login_session['username'])
-    url = 'https://accounts.google.com/o/oauth2/revoke?token={}'.format(
-        login_session['access_token'])
-
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
+    try:
+        revoked = oauthClient().revoke(login_session['access_token'])
+    except OAuthError:
+        revoked = False
     print('result is ')
-    print(result)
-    if result['status'] == '200':
+    print(revoked)
+    if revoked:
         del login_session['access_token']
         del login_session['google_id']
         del login_session['username']
         del login_session['email']
         del login_session['picture']
         del login_session['user_id']
-        global g_authenticated
-        g_authenticated = False
+        regenerateSession()
+        rotateState()
         return json.dumps({'message': 'Successfully logged out'})
     else:
         return json.dumps({'message': 'Could not log out successfully'})
@@ -217,7 +685,7 @@ def newCategoryItem():
     """
 
     if request.method == 'POST':
-        if request.form['state'] != login_session['state']:
+        if not isValidState(request.form.get('state')):
             response = make_response(json.dumps('Unauthorized!!!'), 401)
             response.headers['Content-type'] = 'application/json'
             return response
@@ -227,55 +695,354 @@ def newCategoryItem():
                        cat_id=request.form['category'],
                        user_id=login_session['user_id'])
         g_session.add(newItem)
-        g_session.commit()
+        try:
+            g_session.commit()
+        except IntegrityError:
+            g_session.rollback()
+            return itemExistsResponse()
         result = "Item added successfully"
-        refreshState()
+        rotateState()
         return render_template('additem.html',
                                STATE=login_session['state'],
-                               categories=g_categories,
+                               categories=g_categoryRegistry.all(),
                                result=result,
-                               authenticated=g_authenticated)
+                               authenticated=isAuthenticated())
     else:
-        refreshState()
         return render_template('additem.html',
-                               STATE=login_session['state'],
-                               categories=g_categories,
-                               authenticated=g_authenticated)
+                               STATE=ensureState(),
+                               categories=g_categoryRegistry.all(),
+                               authenticated=isAuthenticated())
+
+
+def isInteger(value):
+    """ Tells whether a value decoded from JSON is an integer. JSON true
+    and false decode to bool, which Python counts as int.
+    """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def checkItemFields(operation, required):
+    """ Checks the title, description and cat_id fields of a batch
+    operation.
+
+    Args:
+        operation: operation received from the client
+        required: whether title and cat_id have to be present
+
+    Returns:
+        An error message, None if the fields are valid
+    """
+    if 'title' in operation or required:
+        title = operation.get('title')
+        if not isinstance(title, str) or not title.strip():
+            return 'Missing title'
+        if len(title) > Item.title.property.columns[0].type.length:
+            return 'Title too long'
+    desc = operation.get('description')
+    if desc is not None:
+        if not isinstance(desc, str):
+            return 'Invalid description'
+        if len(desc) > Item.desc.property.columns[0].type.length:
+            return 'Description too long'
+    if 'cat_id' in operation or required:
+        cat_id = operation.get('cat_id')
+        if not isInteger(cat_id) or \
+                g_categoryRegistry.byId(cat_id) is None:
+            return 'Invalid category'
+    return None
+
+
+def temporaryTitle():
+    """ Returns a title no item has, for an item whose title is being
+    taken over by another item of a batch.
+    """
+    return '~' + secrets.token_hex(15)
+
+
+def checkBatch(operations, user_id):
+    """ Checks the operations of a batch without changing anything.
+
+    Args:
+        operations: list of operations received from the client
+        user_id: id of the signed in user
+
+    Returns:
+        (errors, items) tuple. errors maps the index of every invalid
+        operation to (status, message); items maps the ids of the items
+        updated or deleted to the loaded items.
+    """
+    errors = {}
+    ids = {}
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or \
+                operation.get('op') not in ('create', 'update', 'delete'):
+            errors[index] = (400, 'Invalid operation')
+        elif operation['op'] == 'create':
+            if 'id' in operation:
+                errors[index] = (400, 'New items have no id')
+        elif not isInteger(operation.get('id')):
+            errors[index] = (400, 'Missing id')
+        elif operation['id'] in ids:
+            errors[index] = (400, 'Item changed more than once')
+        else:
+            ids[operation['id']] = index
+
+    items = {}
+    idList = sorted(ids)
+    for start in range(0, len(idList), BATCH_QUERY_SIZE):
+        items.update((item.id, item) for item in g_session.query(Item).filter(
+            Item.id.in_(idList[start:start + BATCH_QUERY_SIZE])))
+
+    for index, operation in enumerate(operations):
+        if index in errors:
+            continue
+        if operation['op'] != 'create':
+            item = items.get(operation['id'])
+            if item is None:
+                errors[index] = (404, 'Invalid item')
+                continue
+            if item.user_id != user_id:
+                errors[index] = (401, 'Unauthorized!!!')
+                continue
+        if operation['op'] != 'delete':
+            message = checkItemFields(operation,
+                                      required=operation['op'] == 'create')
+            if message is not None:
+                errors[index] = (400, message)
+
+    # Titles are unique within a category, both among the items of the
+    # batch and against the items it leaves in place
+    keys = {}
+    finalKeys = {}
+    for index, operation in enumerate(operations):
+        if index in errors:
+            continue
+        item = items.get(operation.get('id'))
+        if operation['op'] == 'delete':
+            finalKeys[item.id] = None
+            continue
+        key = (operation.get('cat_id', getattr(item, 'cat_id', None)),
+               operation.get('title', getattr(item, 'title', None)))
+        if item is not None:
+            finalKeys[item.id] = key
+        if key in keys:
+            errors[index] = (409, 'Title taken by another item of the batch')
+        else:
+            keys[key] = index
+
+    titles = sorted(set(title for _, title in keys))
+    for start in range(0, len(titles), BATCH_QUERY_SIZE):
+        rows = g_session.query(Item.id, Item.cat_id, Item.title).filter(
+            Item.title.in_(titles[start:start + BATCH_QUERY_SIZE]))
+        for row in rows:
+            index = keys.get((row.cat_id, row.title))
+            if index is None or row.id == operations[index].get('id'):
+                continue
+            # The title is free if the batch deletes or renames its holder
+            if row.id not in finalKeys or \
+                    finalKeys[row.id] == (row.cat_id, row.title):
+                errors[index] = (409, 'An item with this title already '
+                                      'exists in the category')
+    return errors, items
+
+
+@g_app.route('/items/batch', methods=['POST'])
+@auth.login_required
+def batchItems():
+    """ JSON endpoint creating, updating and deleting many items at once
+
+    The request body holds the state token and a list of operations:
+    {"op": "create", "title", "description", "cat_id"},
+    {"op": "update", "id", and any of "title", "description", "cat_id"}
+    or {"op": "delete", "id"}. Only the creator of an item can update or
+    delete it.
+
+    All operations are checked first and then applied in a single
+    transaction, so either all of them take effect or none does.
+
+    Returns:
+        on POST:
+            A result per operation, in the order received, and the state
+            token for the next request. 400 when any operation is invalid,
+            with the reason given in its result (other results have status
+            424); 413 for more than MAX_BATCH_ITEMS operations; 409 when a
+            concurrent change made a title clash.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or \
+            not isinstance(body.get('items'), list):
+        response = make_response(json.dumps('Invalid request'), 400)
+        response.headers['Content-type'] = 'application/json'
+        return response
+
+    if not isValidState(body.get('state')):
+        response = make_response(json.dumps('Unauthorized!!!'), 401)
+        response.headers['Content-type'] = 'application/json'
+        return response
+
+    operations = body['items']
+    if len(operations) > MAX_BATCH_ITEMS:
+        response = make_response(json.dumps(
+            'At most {} items per batch'.format(MAX_BATCH_ITEMS)), 413)
+        response.headers['Content-type'] = 'application/json'
+        return response
+
+    user_id = login_session['user_id']
+    errors, items = checkBatch(operations, user_id)
+    if errors:
+        g_session.rollback()
+        results = []
+        for index, operation in enumerate(operations):
+            status, message = errors.get(
+                index, (424, 'Not applied, other items are invalid'))
+            results.append({'index': index, 'status': status,
+                            'error': message})
+        response = make_response(json.dumps({'results': results}), 400)
+        response.headers['Content-type'] = 'application/json'
+        return response
+
+    # Deletes and renames are flushed first, so the titles they free can
+    # be taken by the other items of the batch. A flush writes updates in
+    # primary key order, so items taking the title of another updated item
+    # (chains and swaps of titles) first get a temporary title, and their
+    # own once all other updates are written.
+    created = []
+    try:
+        for operation in operations:
+            if operation['op'] == 'delete':
+                g_session.delete(items[operation['id']])
+        g_session.flush()
+        updates = [operation for operation in operations
+                   if operation['op'] == 'update']
+        holders = dict(((items[operation['id']].cat_id,
+                         items[operation['id']].title), operation['id'])
+                       for operation in updates)
+        pending = []
+        for operation in updates:
+            item = items[operation['id']]
+            cat_id = operation.get('cat_id', item.cat_id)
+            title = operation.get('title', item.title)
+            if 'description' in operation:
+                item.desc = operation['description']
+            if holders.get((cat_id, title), item.id) != item.id:
+                item.title = temporaryTitle()
+                pending.append((item, cat_id, title))
+            else:
+                item.cat_id = cat_id
+                item.title = title
+        g_session.flush()
+        for item, cat_id, title in pending:
+            item.cat_id = cat_id
+            item.title = title
+        if pending:
+            g_session.flush()
+        for operation in operations:
+            if operation['op'] == 'create':
+                newItem = Item(title=operation['title'],
+                               desc=operation.get('description'),
+                               cat_id=operation['cat_id'],
+                               user_id=user_id)
+                g_session.add(newItem)
+                created.append(newItem)
+        g_session.flush()
+        results = []
+        newItems = iter(created)
+        for index, operation in enumerate(operations):
+            if operation['op'] == 'create':
+                results.append({'index': index, 'status': 201,
+                                'id': next(newItems).id})
+            else:
+                results.append({'index': index, 'status': 200,
+                                'id': operation['id']})
+        g_session.commit()
+    except IntegrityError:
+        g_session.rollback()
+        return itemExistsResponse()
+
+    rotateState()
+    return jsonify(results=results, state=login_session['state'])
 
 
 @g_app.route('/catalog/<cat_name>/items', methods=['GET'])
 def getAllCategoryItems(cat_name):
-    """ Returns all the items in the specified category
+    """ Returns the items in the specified category, one page at a time
 
     Args:
         cat_name: name of the category whose items need to be returned
 
     Returns:
         on GET:
-            Page is presented with all items in the requested Category
+            Page is presented with a page of items in the requested Category
     """
 
-    category = list(cat for cat in g_categories if cat.name == cat_name)
+    category = g_categoryRegistry.byName(cat_name)
 
-    if not category:
+    if category is None:
         response = make_response(json.dumps('Invalid category'), 404)
         response.headers['Content-type'] = 'application/json'
         return response
 
-    items = g_session.query(Item).filter_by(cat_id=category[0].id)
-
-    if not items:
-        response = make_response(json.dumps('Invalid item'), 404)
-        response.headers['Content-type'] = 'application/json'
+    # The listing changes with the counters of the category. The sidebar
+    # shows the counts of all categories, so any item change counts too.
+    counters = g_session.query(Category.item_count,
+                               Category.last_item_update).\
+        filter(Category.id == category.id).one()
+    etag = pageEtag('category', category.id, tuple(counters),
+                    request.args.get('after'), request.args.get('before'),
+                    request.args.get('size'),
+                    g_versions.get(ITEMS_VERSION),
+                    g_versions.get(CATEGORIES_VERSION))
+    response = notModifiedResponse(etag)
+    if response is not None:
         return response
 
-    refreshState()
+    page = render_template('index.html',
+                           STATE=ensureState(),
+                           categoriesFragment=categoriesFragment(),
+                           itemsFragment=itemsFragment(
+                               g_session.query(Item).filter(
+                                   Item.cat_id == category.id),
+                               cat_name + " Items",
+                               showCategory=False,
+                               cat_id=category.id),
+                           authenticated=isAuthenticated())
+    return conditionalPage(page, etag, counters.last_item_update)
+
+
+@g_app.route('/search', methods=['GET'])
+def search():
+    """ Searches the titles and descriptions of all items
+
+    Returns:
+        on GET:
+            Page is presented with a page of the items matching the 'q'
+            argument, best matches first
+    """
+    terms = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    page = max(1, min(page, SEARCH_MAX_PAGES))
+    size = request.args.get('size', ITEMS_PER_PAGE, type=int)
+    size = max(1, min(size, MAX_ITEMS_PER_PAGE))
+
+    def render():
+        items, hasNext = searchItems(terms, page, size) if terms \
+            else ([], False)
+        return render_template('_search.html',
+                               items=items,
+                               terms=terms,
+                               page=page,
+                               hasNext=hasNext and page < SEARCH_MAX_PAGES,
+                               categoryById=g_categoryRegistry.byId)
+
+    key = ('search', terms, page, size,
+           g_versions.get(ITEMS_VERSION), g_versions.get(CATEGORIES_VERSION))
+
     return render_template('index.html',
-                           STATE=login_session['state'],
-                           categories=g_categories,
-                           items=items,
-                           authenticated=g_authenticated,
-                           itemsHeading=cat_name + " Items")
+                           STATE=ensureState(),
+                           categoriesFragment=categoriesFragment(),
+                           itemsFragment=cachedFragment(key, render),
+                           searchTerms=terms,
+                           authenticated=isAuthenticated())
 
 
 @g_app.route('/catalog/<cat_name>/<item_title>', methods=['GET'])
@@ -292,35 +1059,43 @@ def getItemDesc(cat_name, item_title):
             If the requester is the creator of the item, options to
             edit and delete are visible.
     """
-    category = list(cat for cat in g_categories if cat.name == cat_name)
+    category = g_categoryRegistry.byName(cat_name)
 
-    if not category:
+    if category is None:
         response = make_response(json.dumps('Invalid category'), 404)
         response.headers['Content-type'] = 'application/json'
         return response
 
     item = g_session.query(Item).\
         filter(Item.title == item_title).\
-        filter(Item.cat_id == category[0].id).first()
+        filter(Item.cat_id == category.id).first()
 
     if item is None:
         response = make_response(json.dumps('Invalid item'), 404)
         response.headers['Content-type'] = 'application/json'
         return response
 
-    refreshState()
+    # Timestamps have a resolution of a second, the description itself
+    # tells apart edits made within the same second.
+    etag = pageEtag('item', item.id, item.lastupdated, item.user_id,
+                    item.desc)
+    response = notModifiedResponse(etag)
+    if response is not None:
+        return response
 
     isCreator = False
-    if g_authenticated is True:
+    if isAuthenticated():
         if login_session['user_id'] == item.user_id:
             isCreator = True
 
-    return render_template('item_page.html',
-                           STATE=login_session['state'],
+    page = render_template('item_page.html',
+                           STATE=ensureState(),
                            item_title=item_title,
+                           cat_id=item.cat_id,
                            desc=item.desc,
-                           authenticated=g_authenticated,
+                           authenticated=isAuthenticated(),
                            isCreator=isCreator)
+    return conditionalPage(page, etag, item.lastupdated)
 
 
 @g_app.route('/catalog/<item_title>/edit', methods=['GET', 'POST'])
@@ -339,7 +1114,7 @@ def editItem(item_title):
             This operation can only be performed by the creator of the item
     """
     if request.method == 'POST':
-        if request.form['state'] != login_session['state']:
+        if not isValidState(request.form.get('state')):
             response = make_response(json.dumps('Unauthorized!!!'), 401)
             response.headers['Content-type'] = 'application/json'
             return response
@@ -359,21 +1134,25 @@ def editItem(item_title):
 
         item.title = request.form['name']
         item.desc = request.form['desc']
-        g_session.commit()
+        try:
+            g_session.commit()
+        except IntegrityError:
+            g_session.rollback()
+            return itemExistsResponse()
         result = "Item modified successfully"
+        rotateState()
 
         return render_template('item_page.html',
                                result=result,
                                STATE=login_session['state'],
                                item_title=item.title,
+                               cat_id=item.cat_id,
                                desc=item.desc,
-                               authenticated=g_authenticated)
+                               authenticated=isAuthenticated())
     else:
-        refreshState()
-
         # Not filtering with user id
         # in order to identify the unauthorized access
-        item = g_session.query(Item).filter_by(title=item_title).first()
+        item = findItemByTitle(item_title)
 
         if item is None:
             response = make_response(json.dumps('Invalid item'), 404)
@@ -388,10 +1167,10 @@ def editItem(item_title):
         return render_template('edititem.html',
                                currentTitle=item_title,
                                currentId=item.id,
-                               STATE=login_session['state'],
+                               STATE=ensureState(),
                                desc=item.desc,
-                               categories=g_categories,
-                               authenticated=g_authenticated)
+                               categories=g_categoryRegistry.all(),
+                               authenticated=isAuthenticated())
 
 
 @g_app.route('/catalog/<item_title>/delete', methods=['GET', 'POST'])
@@ -411,7 +1190,7 @@ def deleteItem(item_title):
     """
     if request.method == 'POST':
         pageData = json.loads(request.data)
-        if pageData["state"] != login_session['state']:
+        if not isValidState(pageData.get("state")):
             response = make_response(json.dumps('Unauthorized!!!'), 401)
             response.headers['Content-type'] = 'application/json'
             return response
@@ -430,11 +1209,11 @@ def deleteItem(item_title):
 
         g_session.delete(item)
         g_session.commit()
+        rotateState()
 
         return json.dumps({'message': 'Item deleted successfully'})
     else:
-        refreshState()
-        item = g_session.query(Item).filter_by(title=item_title).first()
+        item = findItemByTitle(item_title)
 
         if item is None:
             response = make_response(json.dumps('Invalid item'), 404)
@@ -449,29 +1228,82 @@ def deleteItem(item_title):
         return render_template('deleteitem.html',
                                item_title=item_title,
                                itemId=item.id,
-                               STATE=login_session['state'],
+                               STATE=ensureState(),
                                desc=item.desc,
-                               categories=g_categories,
-                               authenticated=g_authenticated)
+                               categories=g_categoryRegistry.all(),
+                               authenticated=isAuthenticated())
 
 
 @g_app.route('/catalog.json')
 def getCatalog():
     """ JSON endpoint returns all categories and items present in the Catalog
 
+    The document is streamed from a server side cursor instead of being
+    built in memory, straight from the item columns without loading ORM
+    objects. Responses carry an ETag derived from the catalog
+    versions and a Last-Modified header, so clients polling an unchanged
+    catalog get a 304 without the items being read at all.
+
     Returns:
         on GET:
             All categories and items in JSON format
     """
-    categories = DBSession().query(Category).options(
-                                joinedload(Category.items)).all()
-    return jsonify(dict(
-                    Category=[dict(
-                            category.serialize,
-                            Items=[i.serialize for i in category.items])
-                            for category in categories]))
+    etag = hashlib.sha1('{}|{}'.format(
+        g_versions.get(ITEMS_VERSION),
+        g_versions.get(CATEGORIES_VERSION)).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    lastupdated = g_session.query(
+        func.max(Category.last_item_update)).scalar()
+
+    def generate():
+        return generateCatalogJson(g_categoryRegistry.all(),
+                                   itemBatches(g_session.connection()))
+
+    response = Response(stream_with_context(generate()),
+                        mimetype='application/json')
+    response.set_etag(etag)
+    if lastupdated is not None:
+        response.last_modified = lastupdated
+    return response.make_conditional(request)
+
+
+@g_app.route('/catalog/changes')
+def getChanges():
+    """ JSON endpoint returning the changes made to the catalog items
+    since a cursor, for clients keeping a copy of the catalog in sync.
+
+    A client starts from a full copy or from the start of the feed (no
+    'since' argument) and then keeps passing the cursor of the previous
+    answer. Changes are to be applied in the order given; while 'more' is
+    true, further changes can be fetched right away.
+
+    Returns:
+        on GET:
+            Up to 'size' changes after the 'since' cursor, the cursor to
+            continue from and whether more changes are waiting. 400 for
+            malformed cursors.
+    """
+    size = request.args.get('size', CHANGES_PER_PAGE, type=int)
+    size = max(1, min(size, MAX_CHANGES_PER_PAGE))
+    try:
+        position = catalogchanges.decodeCursor(request.args.get('since'))
+    except catalogchanges.CursorError:
+        response = make_response(json.dumps('Invalid cursor'), 400)
+        response.headers['Content-type'] = 'application/json'
+        return response
+
+    changes, position, more = catalogchanges.readChanges(
+        g_session.connection(), position, size)
+    return jsonify(changes=changes,
+                   cursor=catalogchanges.encodeCursor(position),
+                   more=more)
 
 
 if __name__ == '__main__':
-    g_app.debug = True
-    g_app.run(host='0.0.0.0', port=5000)
+    app = create_app()
+    app.debug = True
+    app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,170 @@
+"""
+Tests of the Catalog App routes, run against a temporary SQLite database:
+
+    python -m unittest views_test
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import views
+from databasemodels import Category, Item, User
+
+
+g_directory = None
+
+
+def setUpModule():
+    global g_directory
+    g_directory = tempfile.mkdtemp()
+    views.create_app('sqlite:///' + os.path.join(g_directory, 'catalog.db'))
+    views.ensureResources()
+    session = views.g_session
+    session.add_all([User(id=1, username='Owner'),
+                     User(id=2, username='Other'),
+                     Category(id=1, name='Soccer'),
+                     Category(id=2, name='Hockey')])
+    session.commit()
+    views.g_session.remove()
+
+
+def tearDownModule():
+    views.g_engine.dispose()
+    shutil.rmtree(g_directory)
+
+
+class BatchItemsTest(unittest.TestCase):
+    """ POST /items/batch """
+
+    def setUp(self):
+        self.client = views.g_app.test_client()
+        with self.client.session_transaction() as session:
+            session['username'] = 'Owner'
+            session['user_id'] = 1
+            session['state'] = 'state'
+        item = Item(title=self.id()[-32:], desc='Text', cat_id=1, user_id=1)
+        views.g_session.add(item)
+        views.g_session.commit()
+        self.item_id = item.id
+        views.g_session.remove()
+
+    def post(self, *operations):
+        return self.client.post(
+            '/items/batch', data=json.dumps({'state': 'state',
+                                             'items': list(operations)}),
+            content_type='application/json')
+
+    def item(self):
+        item = views.g_session.query(Item).get(self.item_id)
+        views.g_session.remove()
+        return item
+
+    def addItem(self, title):
+        item = Item(title=title, cat_id=1, user_id=1)
+        views.g_session.add(item)
+        views.g_session.commit()
+        item_id = item.id
+        views.g_session.remove()
+        return item_id
+
+    def titles(self, *ids):
+        titles = [views.g_session.query(Item).get(item_id).title
+                  for item_id in ids]
+        views.g_session.remove()
+        return titles
+
+    def assertRejected(self, response, status, message):
+        self.assertEqual(response.status_code, 400)
+        result = response.get_json()['results'][0]
+        self.assertEqual(result['status'], status)
+        self.assertEqual(result['error'], message)
+
+    def test_create_update_delete(self):
+        response = self.post(
+            {'op': 'create', 'title': 'Created', 'cat_id': 2},
+            {'op': 'update', 'id': self.item_id, 'description': 'New'})
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['results']
+        self.assertEqual([result['status'] for result in results],
+                         [201, 200])
+        self.assertEqual(self.item().desc, 'New')
+
+        with self.client.session_transaction() as session:
+            session['state'] = 'state'
+        response = self.post({'op': 'delete', 'id': results[0]['id']})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(views.g_session.query(Item).get(results[0]['id']))
+        views.g_session.remove()
+
+    def test_rename_chain(self):
+        # The item with the lower id takes the title of the other one,
+        # which is renamed in the same batch
+        first = self.addItem('Chain B')
+        second = self.addItem('Chain A')
+        response = self.post(
+            {'op': 'update', 'id': second, 'title': 'Chain C'},
+            {'op': 'update', 'id': first, 'title': 'Chain A'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.titles(first, second), ['Chain A', 'Chain C'])
+
+    def test_swap_titles(self):
+        first = self.addItem('Swap A')
+        second = self.addItem('Swap B')
+        response = self.post(
+            {'op': 'update', 'id': first, 'title': 'Swap B'},
+            {'op': 'update', 'id': second, 'title': 'Swap A'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.titles(first, second), ['Swap B', 'Swap A'])
+
+    def test_move_into_freed_title(self):
+        # An item moves to a category whose item of the same title moves
+        # out, and a new item takes the title the first one left
+        first = self.addItem('Moved')
+        second = Item(title='Moved', cat_id=2, user_id=1)
+        views.g_session.add(second)
+        views.g_session.commit()
+        second = second.id
+        views.g_session.remove()
+        response = self.post({'op': 'update', 'id': second, 'cat_id': 1,
+                              'title': 'Moved back'},
+                             {'op': 'update', 'id': first, 'cat_id': 2},
+                             {'op': 'create', 'title': 'Moved', 'cat_id': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.titles(first, second), ['Moved', 'Moved back'])
+
+    def test_null_category_rejected(self):
+        response = self.post({'op': 'update', 'id': self.item_id,
+                              'cat_id': None})
+        self.assertRejected(response, 400, 'Invalid category')
+        self.assertEqual(self.item().cat_id, 1)
+
+    def test_null_title_rejected(self):
+        response = self.post({'op': 'update', 'id': self.item_id,
+                              'title': None})
+        self.assertRejected(response, 400, 'Missing title')
+        response = self.post({'op': 'create', 'title': None, 'cat_id': 1})
+        self.assertRejected(response, 400, 'Missing title')
+
+    def test_bool_category_rejected(self):
+        response = self.post({'op': 'create', 'title': 'Bool', 'cat_id': True})
+        self.assertRejected(response, 400, 'Invalid category')
+
+    def test_bool_id_rejected(self):
+        response = self.post({'op': 'update', 'id': True, 'title': 'Bool'})
+        self.assertRejected(response, 400, 'Missing id')
+        response = self.post({'op': 'delete', 'id': False})
+        self.assertRejected(response, 400, 'Missing id')
+
+    def test_other_users_item_rejected(self):
+        with self.client.session_transaction() as session:
+            session['user_id'] = 2
+        response = self.post({'op': 'delete', 'id': self.item_id})
+        self.assertRejected(response, 401, 'Unauthorized!!!')
+        self.assertIsNotNone(self.item())
+
+
+if __name__ == '__main__':
+    unittest.main()
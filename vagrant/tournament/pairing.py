@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+#
+# pairing.py -- Swiss pairing engine for large events
+#
+
+import itertools
+
+# Steps the search for a rematch free pairing may take on the players the
+# bracket pairing left with a rematch, before giving up and keeping it.
+REPAIR_STEPS = 100000
+
+
+class _Pool(object):
+    """Players waiting for an opponent, in standings order.
+
+    Kept as a doubly linked list, so a paired player is removed in O(1)
+    and a scan for an opponent only ever visits unpaired players.
+    """
+
+    def __init__(self, players):
+        self.first = players[0] if players else None
+        self.next = {}
+        self.prev = {}
+        for before, after in zip(players, players[1:]):
+            self.next[before] = after
+            self.prev[after] = before
+
+    def remove(self, player):
+        before = self.prev.pop(player, None)
+        after = self.next.pop(player, None)
+        if before is None:
+            self.first = after
+        else:
+            self.next[before] = after
+        if after is not None:
+            self.prev[after] = before
+        elif before is not None:
+            del self.next[before]
+
+    def __iter__(self):
+        player = self.first
+        while player is not None:
+            following = self.next.get(player)
+            yield player
+            player = following
+
+
+def chooseBye(ranked, byes):
+    """Returns the player who sits out the round when the number of
+    players is odd: the lowest ranked one who had no bye yet.
+
+    Args:
+      ranked: player ids, best first
+      byes: ids of the players who already had a bye
+    """
+    for player in reversed(ranked):
+        if player not in byes:
+            return player
+    return ranked[-1]
+
+
+def pairBracket(pool, opponents):
+    """Pairs a score bracket: the top half against the bottom half, each
+    player with the first player of the other half they haven't met.
+
+    Args:
+      pool: player ids of the bracket, best first, including the players
+        floated down from the brackets above
+      opponents: dict of player id to the set of ids already played
+
+    Returns:
+      (pairs, floaters) tuple. floaters are the players left unpaired, to
+      be paired in the next bracket down.
+    """
+    half = len(pool) // 2
+    bottom = _Pool(pool[half:])
+    pairs = []
+    floaters = []
+    for player in pool[:half]:
+        played = opponents.get(player, ())
+        for candidate in bottom:
+            if candidate not in played:
+                pairs.append((player, candidate))
+                bottom.remove(candidate)
+                break
+        else:
+            floaters.append(player)
+    floaters.extend(bottom)
+    return pairs, floaters
+
+
+def pairLeftovers(players, pairs, opponents):
+    """Pairs the players no bracket could pair, appending to pairs.
+
+    Each player gets the nearest leftover they haven't met, or the nearest
+    leftover when they met them all; repairRematches() undoes those
+    rematches where it can.
+    """
+    pool = _Pool(players)
+    while pool.first is not None:
+        player = pool.first
+        pool.remove(player)
+        played = opponents.get(player, ())
+        partner = pool.first
+        for candidate in pool:
+            if candidate not in played:
+                partner = candidate
+                break
+        pool.remove(partner)
+        pairs.append((player, partner))
+
+
+def pairWithoutRematches(players, opponents, steps=REPAIR_STEPS):
+    """Searches for a pairing of players in which nobody meets a player
+    they met before.
+
+    A depth first search: the best ranked unpaired player is paired with
+    the nearest ranked player they haven't met, backtracking on dead ends.
+    The unpaired players are kept in a linked list which removals can be
+    undone from in O(1), so each step only visits unpaired players.
+
+    Args:
+      players: player ids, best first; an even number of them
+      opponents: dict of player id to the set of ids already played
+      steps: number of backtracks after which the search gives up
+
+    Returns:
+      The list of (id1, id2) pairs, or None if no rematch free pairing was
+      found.
+    """
+    head = len(players)
+    following = list(range(1, head + 1)) + [0]
+    preceding = [head] + list(range(head))
+
+    def unlink(index):
+        following[preceding[index]] = following[index]
+        preceding[following[index]] = preceding[index]
+
+    def relink(index):
+        following[preceding[index]] = index
+        preceding[following[index]] = index
+
+    def candidate(index, start):
+        played = opponents.get(players[index], ())
+        while start != head and players[start] in played:
+            start = following[start]
+        return start
+
+    chosen = []
+    while following[head] != head:
+        player = following[head]
+        unlink(player)
+        partner = candidate(player, following[player])
+        while partner == head:
+            relink(player)
+            if not chosen or steps <= 0:
+                return None
+            steps -= 1
+            player, partner = chosen.pop()
+            relink(partner)
+            partner = candidate(player, following[partner])
+        unlink(partner)
+        chosen.append((player, partner))
+    return [(players[player], players[partner])
+            for player, partner in chosen]
+
+
+def repairRematches(pairs, opponents, rank):
+    """Re-pairs the players of rematches together with the pairs above
+    them, so that nobody meets twice.
+
+    Rematches are only made by pairLeftovers(), at the end of pairs. They
+    are searched for a rematch free pairing together with as many pairs
+    from above, doubling those until one is found or the whole field was
+    searched.
+
+    Args:
+      pairs: list of (id1, id2) pairs of the round
+      opponents: dict of player id to the set of ids already played
+      rank: dict of player id to their place in the standings
+
+    Returns:
+      The pairs, with as few rematches as were found
+    """
+    rematches = [index for index, (first, second) in enumerate(pairs)
+                 if second in opponents.get(first, ())]
+    if not rematches:
+        return pairs
+    extra = len(rematches)
+    while True:
+        start = max(0, rematches[0] - extra)
+        players = sorted((player for pair in pairs[start:] for player in pair),
+                         key=rank.get)
+        repaired = pairWithoutRematches(players, opponents)
+        if repaired is not None:
+            return pairs[:start] + repaired
+        if start == 0:
+            return pairs
+        extra *= 2
+
+
+def pairRound(ranked, opponents, byes=()):
+    """Pairs the next round of a Swiss event.
+
+    Players are split into brackets of equal score. Each bracket is paired
+    top half against bottom half; players who can't be paired without a
+    rematch float down to the next bracket. Every player is looked at
+    once and only scans past opponents already played, so after sorting
+    the work is about linear in the number of players.
+
+    Players left at the bottom with a rematch are then paired again with
+    the pairs above them by repairRematches(). A rematch remains only when
+    no rematch free pairing exists, or none was found within REPAIR_STEPS
+    steps of the search.
+
+    Args:
+      ranked: list of (id, score) tuples, best first
+      opponents: dict of player id to the set of ids already played
+      byes: ids of the players who already had a bye
+
+    Returns:
+      (pairs, bye) tuple. pairs is a list of (id1, id2) tuples, best
+      ranked pairs first; bye is the id of the player sitting out, None
+      for an even number of players.
+    """
+    ids = [player for player, score in ranked]
+    bye = None
+    if len(ids) % 2:
+        bye = chooseBye(ids, set(byes))
+        ranked = [entry for entry in ranked if entry[0] != bye]
+
+    pairs = []
+    floaters = []
+    for score, bracket in itertools.groupby(ranked, lambda entry: entry[1]):
+        pool = floaters + [player for player, score in bracket]
+        bracketPairs, floaters = pairBracket(pool, opponents)
+        pairs.extend(bracketPairs)
+    pairLeftovers(floaters, pairs, opponents)
+    rank = dict((player, index) for index, player in enumerate(ids))
+    return repairRematches(pairs, opponents, rank), bye
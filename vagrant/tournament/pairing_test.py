@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Test cases for pairing.py
+# These need no database; run with: python pairing_test.py
+
+import random
+
+from pairing import pairRound
+
+
+def playEvent(players, rounds, seed):
+    """Plays a random event, yielding the arguments and result of the
+    pairing of every round."""
+    rng = random.Random(seed)
+    scores = dict((player, 0) for player in range(1, players + 1))
+    opponents = {}
+    byes = set()
+    for round in range(rounds):
+        ranked = sorted(scores.items(), key=lambda entry: (-entry[1], entry[0]))
+        played = dict((player, set(met)) for player, met in opponents.items())
+        pairs, bye = pairRound(ranked, played, set(byes))
+        yield ranked, played, byes, pairs, bye
+        for first, second in pairs:
+            opponents.setdefault(first, set()).add(second)
+            opponents.setdefault(second, set()).add(first)
+            scores[first if rng.random() < .5 else second] += 1
+        if bye is not None:
+            byes.add(bye)
+            scores[bye] += 1
+
+
+def canPair(players, opponents):
+    """Tells by exhaustive search whether players can be paired without a
+    rematch."""
+    if not players:
+        return True
+    first = players[0]
+    for index in range(1, len(players)):
+        if players[index] not in opponents.get(first, ()) and \
+                canPair(players[1:index] + players[index + 1:], opponents):
+            return True
+    return False
+
+
+def testCoverage():
+    """
+    Test that every player is paired exactly once, or has the bye.
+    """
+    for players in range(2, 30):
+        for ranked, played, byes, pairs, bye in playEvent(players, 5, players):
+            paired = [player for pair in pairs for player in pair]
+            if bye is not None:
+                paired.append(bye)
+            if sorted(paired) != list(range(1, players + 1)):
+                raise ValueError(
+                    "Each player should be paired exactly once. Got {pairs}".format(pairs=pairs))
+            if (bye is not None) != (players % 2 == 1):
+                raise ValueError("Only an odd number of players should get a bye.")
+    print("1. Every player is paired exactly once.")
+
+
+def testByes():
+    """
+    Test that the bye goes to the lowest ranked player without one.
+    """
+    for ranked, played, byes, pairs, bye in playEvent(9, 8, 1):
+        without = [player for player, score in ranked if player not in byes]
+        if bye != without[-1]:
+            raise ValueError(
+                "The bye should go to {expected}, not {bye}.".format(expected=without[-1], bye=bye))
+    print("2. The lowest ranked player without a bye gets it.")
+
+
+def testBrackets():
+    """
+    Test that the first round pairs the top half against the bottom half,
+    and later rounds pair players of equal scores.
+    """
+    pairs, bye = pairRound([(player, 0) for player in range(1, 9)], {})
+    if pairs != [(1, 5), (2, 6), (3, 7), (4, 8)]:
+        raise ValueError("The top half should meet the bottom half. Got {pairs}".format(pairs=pairs))
+    ranked = [(1, 1), (3, 1), (5, 1), (7, 1), (2, 0), (4, 0), (6, 0), (8, 0)]
+    opponents = {1: set([5]), 5: set([1]), 2: set([6]), 6: set([2]),
+                 3: set([7]), 7: set([3]), 4: set([8]), 8: set([4])}
+    pairs, bye = pairRound(ranked, opponents)
+    scores = dict(ranked)
+    for first, second in pairs:
+        if scores[first] != scores[second]:
+            raise ValueError("Players of equal scores should be paired. Got {pairs}".format(pairs=pairs))
+    print("3. Score brackets are paired top half against bottom half.")
+
+
+def testRematches():
+    """
+    Test that no rematch is made when a rematch free pairing exists.
+    """
+    for players in range(4, 13):
+        for seed in range(40):
+            for ranked, played, byes, pairs, bye in playEvent(players, min(players - 2, 6), seed):
+                if not any(second in played.get(first, ()) for first, second in pairs):
+                    continue
+                left = [player for player, score in ranked if player != bye]
+                if canPair(left, played):
+                    raise ValueError(
+                        "Avoidable rematch for {ranked} with {played}: {pairs}".format(
+                            ranked=ranked, played=played, pairs=pairs))
+    print("4. Rematches are only made when they can't be avoided.")
+
+
+def testLargeEvent():
+    """
+    Test that a large event is paired without rematches.
+    """
+    for ranked, played, byes, pairs, bye in playEvent(10001, 4, 1):
+        if any(second in played.get(first, ()) for first, second in pairs):
+            raise ValueError("A large event should be paired without rematches.")
+    print("5. A large event is paired without rematches.")
+
+
+if __name__ == '__main__':
+    testCoverage()
+    testByes()
+    testBrackets()
+    testRematches()
+    testLargeEvent()
+    print("Success!  All tests pass!")
@@ -1,45 +1,185 @@
 #!/usr/bin/env python
-# 
+#
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+import contextlib
+import os
+import threading
+
 import psycopg2
+import psycopg2.pool
+
+import pairing
+
+# Tournament of the functions called without one, created with the schema
+DEFAULT_TOURNAMENT = 1
+
+# SQLSTATE of an insert referring to a row which does not exist
+FOREIGN_KEY_VIOLATION = '23503'
+
+# Database to connect to, and the size of the connection pool. A maximum
+# of 0 turns pooling off: each call opens and closes a connection of its
+# own, as the tests do.
+DSN = os.environ.get('TOURNAMENT_DSN', 'dbname=tournament')
+POOL_MIN_SIZE = int(os.environ.get('TOURNAMENT_POOL_MIN_SIZE', '1'))
+POOL_MAX_SIZE = int(os.environ.get('TOURNAMENT_POOL_MAX_SIZE', '10'))
+
+g_pool = None
+g_poolSlots = None
+g_poolPid = None
+g_poolLock = threading.Lock()
 
 
 def connect():
     """Connect to the PostgreSQL database.  Returns a database connection."""
-    return psycopg2.connect("dbname=tournament")
+    return psycopg2.connect(DSN)
+
+
+def connectionPool():
+    """Returns the connection pool of this process, created on first use.
+
+    A process forked from one which already had a pool gets a pool of its
+    own; connections are never shared between processes.
+
+    Returns:
+      (pool, slots) tuple: the pool, and a semaphore counting the
+      connections which can still be taken from it
+    """
+    global g_pool, g_poolSlots, g_poolPid
+    with g_poolLock:
+        if g_pool is None or g_poolPid != os.getpid():
+            g_pool = psycopg2.pool.ThreadedConnectionPool(
+                POOL_MIN_SIZE, POOL_MAX_SIZE, DSN)
+            g_poolSlots = threading.BoundedSemaphore(POOL_MAX_SIZE)
+            g_poolPid = os.getpid()
+        return g_pool, g_poolSlots
+
+
+def closePool():
+    """Closes all the connections of the pool, if one was created."""
+    global g_pool
+    with g_poolLock:
+        if g_pool is not None and g_poolPid == os.getpid():
+            g_pool.closeall()
+        g_pool = None
+
+
+@contextlib.contextmanager
+def connection():
+    """Context manager lending a database connection.
+
+    The connection comes from the pool and goes back to it at the end of
+    the block; when all of them are lent, this waits for one to be
+    returned. With pooling off, a new connection is opened and closed.
+    """
+    if POOL_MAX_SIZE <= 0:
+        conn = connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+
+    pool, slots = connectionPool()
+    slots.acquire()
+    try:
+        conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            if not conn.closed and \
+                    conn.get_transaction_status() != \
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        slots.release()
+
+
+def execute(query, params=None, fetch=False):
+    """Runs a statement in a transaction of its own.
+
+    Args:
+      query: SQL statement, with %s placeholders for params
+      params: parameters of the statement
+      fetch: whether to return the rows the statement produced
+
+    Returns:
+      The rows as a list of tuples if fetch is set, None otherwise
+    """
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, params)
+                if fetch:
+                    return cursor.fetchall()
+
+
+def createTournament(name):
+    """Adds a tournament to the database.
+
+    Args:
+      name: the tournament's name
+
+    Returns:
+      The id of the new tournament, to pass to the other functions
+    """
+    return execute("INSERT INTO tournaments (name) VALUES (%s) RETURNING id",
+                   (name,), fetch=True)[0][0]
+
+
+def deleteTournament(tournament):
+    """Removes a tournament with all its players and matches.
+
+    Args:
+      tournament: the id of the tournament
+    """
+    execute("DELETE FROM tournaments WHERE id = %s", (tournament,))
 
 
-def deleteMatches():
-    """Remove all the match records from the database."""
+def deleteMatches(tournament=DEFAULT_TOURNAMENT):
+    """Remove all the match records of a tournament from the database."""
+    execute("DELETE FROM matches WHERE tournament = %s", (tournament,))
 
 
-def deletePlayers():
-    """Remove all the player records from the database."""
+def deletePlayers(tournament=DEFAULT_TOURNAMENT):
+    """Remove all the player records of a tournament from the database."""
+    execute("DELETE FROM players WHERE tournament = %s", (tournament,))
 
 
-def countPlayers():
+def countPlayers(tournament=DEFAULT_TOURNAMENT):
     """Returns the number of players currently registered."""
+    return int(execute("SELECT count(*) FROM players WHERE tournament = %s",
+                       (tournament,), fetch=True)[0][0])
 
 
-def registerPlayer(name):
+def registerPlayer(name, tournament=DEFAULT_TOURNAMENT):
     """Adds a player to the tournament database.
-  
+
     The database assigns a unique serial id number for the player.  (This
     should be handled by your SQL database schema, not in your Python code.)
-  
+
     Args:
       name: the player's full name (need not be unique).
+      tournament: the id of the tournament the player registers for
     """
+    execute("INSERT INTO players (tournament, name) VALUES (%s, %s)",
+            (tournament, name))
 
 
-def playerStandings():
+def playerStandings(tournament=DEFAULT_TOURNAMENT):
     """Returns a list of the players and their win records, sorted by wins.
 
     The first entry in the list should be the player in first place, or a player
     tied for first place if there is currently a tie.
 
+    The wins and matches of all players are computed by a single aggregate
+    query (the standings view).
+
+    Args:
+      tournament: the id of the tournament
+
     Returns:
       A list of tuples, each of which contains (id, name, wins, matches):
         id: the player's unique id (assigned by the database)
@@ -47,25 +187,122 @@ def playerStandings():
         wins: the number of matches the player has won
         matches: the number of matches the player has played
     """
+    return execute("SELECT id, name, wins, matches FROM standings "
+                   "WHERE tournament = %s ORDER BY wins DESC, id",
+                   (tournament,), fetch=True)
 
 
-def reportMatch(winner, loser):
+def reportMatch(winner, loser, tournament=DEFAULT_TOURNAMENT):
     """Records the outcome of a single match between two players.
 
     Args:
       winner:  the id number of the player who won
       loser:  the id number of the player who lost
+      tournament: the id of the tournament the match was played in
+    """
+    execute("INSERT INTO matches (tournament, winner, loser) "
+            "VALUES (%s, %s, %s)", (tournament, winner, loser))
+
+
+def reportMatches(results, tournament=DEFAULT_TOURNAMENT):
+    """Records the outcomes of a whole round at once.
+
+    All results are written by a single statement, in one transaction and
+    one round trip to the database: either all of them are recorded or,
+    if any is invalid, none.
+
+    Args:
+      results: iterable of (winner, loser) tuples of player ids; a loser
+        of None records a bye for the winner
+      tournament: the id of the tournament the round was played in
+
+    Raises:
+      ValueError: a player appears twice in the results, or a player id
+        is not registered for the tournament
+    """
+    winners = []
+    losers = []
+    seen = set()
+    for winner, loser in results:
+        for player in (winner, loser):
+            if player is None:
+                continue
+            if player in seen:
+                raise ValueError(
+                    "Player {0} appears twice in the results".format(player))
+            seen.add(player)
+        winners.append(winner)
+        losers.append(loser)
+    if not winners:
+        return
+
+    try:
+        execute("INSERT INTO matches (tournament, winner, loser) "
+                "SELECT %s, * FROM unnest(%s::integer[], %s::integer[])",
+                (tournament, winners, losers))
+    except psycopg2.IntegrityError as e:
+        if e.pgcode != FOREIGN_KEY_VIOLATION:
+            raise
+        raise ValueError(
+            "Results name a player who is not registered for the "
+            "tournament ({0}: {1})".format(e.pgcode, e.diag.message_detail))
+
+
+def reportBye(player, tournament=DEFAULT_TOURNAMENT):
+    """Records a bye: the player sits out the round and is awarded a win.
+
+    Args:
+      player: the id number of the player who had the bye
+      tournament: the id of the tournament
+    """
+    execute("INSERT INTO matches (tournament, winner, loser) "
+            "VALUES (%s, %s, NULL)", (tournament, player))
+
+
+def playedOpponents(tournament=DEFAULT_TOURNAMENT):
+    """Returns who played whom so far, read in a single query.
+
+    Args:
+      tournament: the id of the tournament
+
+    Returns:
+      (opponents, byes) tuple. opponents is a dict of player id to the set
+      of ids of the players met; byes is the set of ids of the players who
+      had a bye.
     """
- 
- 
-def swissPairings():
+    opponents = {}
+    byes = set()
+    for winner, loser in execute("SELECT winner, loser FROM matches "
+                                 "WHERE tournament = %s", (tournament,),
+                                 fetch=True):
+        if loser is None:
+            byes.add(winner)
+        else:
+            opponents.setdefault(winner, set()).add(loser)
+            opponents.setdefault(loser, set()).add(winner)
+    return opponents, byes
+
+
+def swissPairings(advanced=False, tournament=DEFAULT_TOURNAMENT):
     """Returns a list of pairs of players for the next round of a match.
-  
+
     Assuming that there are an even number of players registered, each player
     appears exactly once in the pairings.  Each player is paired with another
     player with an equal or nearly-equal win record, that is, a player adjacent
     to him or her in the standings.
-  
+
+    With advanced set the pairing engine of the pairing module is used:
+    players are paired within their score bracket avoiding rematches, which
+    only remain when no rematch free pairing was found within the search
+    budget of pairing.REPAIR_STEPS.  With an odd number of players the
+    lowest ranked player who had no bye yet sits out.  That
+    player is returned as a last tuple with None for id2 and name2; report
+    it with reportBye().
+
+    Args:
+      advanced: whether to pair score brackets avoiding rematches
+      tournament: the id of the tournament
+
     Returns:
       A list of tuples, each of which contains (id1, name1, id2, name2)
         id1: the first player's unique id
@@ -73,5 +310,17 @@ def swissPairings():
         id2: the second player's unique id
         name2: the second player's name
     """
+    standings = playerStandings(tournament)
+    if not advanced:
+        return [(first[0], first[1], second[0], second[1])
+                for first, second in zip(standings[0::2], standings[1::2])]
 
-
+    opponents, byes = playedOpponents(tournament)
+    names = dict((row[0], row[1]) for row in standings)
+    pairs, bye = pairing.pairRound([(row[0], row[2]) for row in standings],
+                                   opponents, byes)
+    pairings = [(first, names[first], second, names[second])
+                for first, second in pairs]
+    if bye is not None:
+        pairings.append((bye, names[bye], None, None))
+    return pairings
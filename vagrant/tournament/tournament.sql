@@ -1,9 +1,68 @@
 -- Table definitions for the tournament project.
 --
--- Put your SQL 'create table' statements in this file; also 'create view'
--- statements if you choose to use it.
---
--- You can write comments in this file by starting them with two dashes, like
--- these lines here.
+-- Load with: psql -f tournament.sql
+-- This drops and recreates the tournament database.
+
+DROP DATABASE IF EXISTS tournament;
+CREATE DATABASE tournament;
+\c tournament
+
+-- Every player and match belongs to a tournament, and every query names
+-- the tournament it is about. The indexes lead with the tournament, so an
+-- event's queries only read its own rows, and deleting a tournament
+-- cascades to its players and matches through them.
+CREATE TABLE tournaments (
+    id serial PRIMARY KEY,
+    name text NOT NULL
+);
+
+-- The tournament used when none is named, id 1.
+INSERT INTO tournaments (name) VALUES ('Default');
+
+CREATE TABLE players (
+    id serial PRIMARY KEY,
+    tournament integer NOT NULL DEFAULT 1
+        REFERENCES tournaments (id) ON DELETE CASCADE,
+    name text NOT NULL,
+    UNIQUE (tournament, id)
+);
+
+-- Matches refer to their players together with the tournament, so both
+-- players of a match are always registered in the tournament of the match.
+CREATE TABLE matches (
+    id serial PRIMARY KEY,
+    tournament integer NOT NULL DEFAULT 1
+        REFERENCES tournaments (id) ON DELETE CASCADE,
+    winner integer NOT NULL,
+    -- A match without a loser is a bye: a free win for the winner.
+    loser integer,
+    FOREIGN KEY (tournament, winner)
+        REFERENCES players (tournament, id) ON DELETE CASCADE,
+    FOREIGN KEY (tournament, loser)
+        REFERENCES players (tournament, id) ON DELETE CASCADE,
+    CHECK (winner <> loser)
+);
 
+-- Standings count the wins and losses of every player; these also serve
+-- the foreign keys when players are deleted.
+CREATE INDEX matches_winner_idx ON matches (tournament, winner);
+CREATE INDEX matches_loser_idx ON matches (tournament, loser);
 
+-- Wins and matches played of every player, computed for all players at
+-- once: matches are aggregated per winner and per loser in one pass each
+-- and joined to the players, rather than counted player by player. The
+-- joins include the tournament, so a condition on it reaches the
+-- aggregates too.
+CREATE VIEW standings AS
+    SELECT players.tournament,
+           players.id,
+           players.name,
+           coalesce(won.wins, 0) AS wins,
+           coalesce(won.wins, 0) + coalesce(lost.losses, 0) AS matches
+    FROM players
+    LEFT JOIN (SELECT tournament, winner AS id, count(*)::integer AS wins
+               FROM matches GROUP BY tournament, winner) AS won
+        ON won.tournament = players.tournament AND won.id = players.id
+    LEFT JOIN (SELECT tournament, loser AS id, count(*)::integer AS losses
+               FROM matches GROUP BY tournament, loser) AS lost
+        ON lost.tournament = players.tournament AND lost.id = players.id;
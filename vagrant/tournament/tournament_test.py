@@ -147,9 +147,106 @@ def testPairings():
     print "10. After one match, players with one win are properly paired."
 
 
+def testAdvancedPairings():
+    """
+    Test that the advanced pairings avoid rematches and hand out byes once.
+    """
+    deleteMatches()
+    deletePlayers()
+    for name in ["Fluttershy", "Applejack", "Pinkie Pie", "Rarity", "Rainbow Dash"]:
+        registerPlayer(name)
+    met = set()
+    byes = set()
+    for round in range(3):
+        pairings = swissPairings(advanced=True)
+        if len(pairings) != 3:
+            raise ValueError(
+                "For five players, advanced swissPairings should return 2 pairs and a bye. Got {pairs}".format(pairs=len(pairings)))
+        for (id1, name1, id2, name2) in pairings:
+            if id2 is None:
+                if id1 in byes:
+                    raise ValueError("No player should get a second bye.")
+                byes.add(id1)
+                reportBye(id1)
+            else:
+                if frozenset([id1, id2]) in met:
+                    raise ValueError("Advanced pairings should avoid rematches.")
+                met.add(frozenset([id1, id2]))
+                reportMatch(id1, id2)
+    [(i1, n1, w1, m1), (i2, n2, w2, m2), (i3, n3, w3, m3), (i4, n4, w4, m4), (i5, n5, w5, m5)] = playerStandings()
+    if m1 != 3 or m5 != 3:
+        raise ValueError("Byes should count as matches played.")
+    print "11. Advanced pairings avoid rematches and give each bye once."
+
+
+def testReportRound():
+    """
+    Test that a whole round is recorded at once, or not at all.
+    """
+    deleteMatches()
+    deletePlayers()
+    for name in ["Spike", "Starlight Glimmer", "Trixie", "Zecora"]:
+        registerPlayer(name)
+    [id1, id2, id3, id4] = [row[0] for row in playerStandings()]
+    for results in ([(id1, id2), (id3, id1)], [(id1, id2), (id3, id4 + 1000)]):
+        try:
+            reportMatches(results)
+        except ValueError:
+            pass
+        else:
+            raise ValueError("reportMatches should reject invalid results.")
+    if any(row[3] for row in playerStandings()):
+        raise ValueError("Rejected results should not record any match.")
+    reportMatches([(id1, id2), (id3, id4)])
+    for (i, n, w, m) in playerStandings():
+        if m != 1:
+            raise ValueError("Each player should have one match recorded.")
+        if i in (id1, id3) and w != 1:
+            raise ValueError("Each match winner should have one win recorded.")
+    print "12. A round of results is recorded in one batch."
+
+
+def testTournaments():
+    """
+    Test that tournaments keep their players and matches apart.
+    """
+    deleteMatches()
+    deletePlayers()
+    other = createTournament("Equestria Games")
+    try:
+        registerPlayer("Princess Celestia")
+        registerPlayer("Princess Luna", other)
+        registerPlayer("Discord", other)
+        if countPlayers() != 1 or countPlayers(other) != 2:
+            raise ValueError("Players should be counted per tournament.")
+        [id1, id2] = [row[0] for row in playerStandings(other)]
+        [id3] = [row[0] for row in playerStandings()]
+        try:
+            reportMatch(id1, id3, other)
+        except Exception:
+            pass
+        else:
+            raise ValueError("Players of another tournament should not be matched.")
+        reportMatch(id1, id2, other)
+        deleteMatches()
+        if playerStandings(other)[0][3] != 1:
+            raise ValueError("Deleting matches should not touch other tournaments.")
+        deletePlayers()
+        if countPlayers(other) != 2:
+            raise ValueError("Deleting players should not touch other tournaments.")
+    finally:
+        deleteTournament(other)
+    if countPlayers(other) != 0:
+        raise ValueError("Deleting a tournament should delete its players.")
+    print "13. Tournaments keep their players and matches apart."
+
+
 if __name__ == '__main__':
     testCount()
     testStandingsBeforeMatches()
     testReportMatches()
     testPairings()
+    testAdvancedPairings()
+    testReportRound()
+    testTournaments()
     print "Success!  All tests pass!"